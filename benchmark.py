@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+"""
+Benchmarks for the systemctl output parsers of serman.
+
+A fixture of generated units is rendered in both the plain text and the JSON
+output formats of systemctl and each parser is timed on it. No systemd is
+required.
+
+Usage: python3 benchmark.py [<number of units>]
+"""
+
+import io
+import json
+import sys
+import timeit
+
+import serman
+
+################################### Fixture ####################################
+
+UNIT_TYPES = ('service', 'socket', 'timer', 'mount', 'path')
+FILE_STATES = ('enabled', 'disabled', 'static', 'masked', 'indirect')
+ACTIVE_STATES = (
+  ('active', 'running'),
+  ('active', 'exited'),
+  ('inactive', 'dead'),
+  ('failed', 'failed'),
+)
+
+def generate_units(n):
+  for i in range(n):
+    name = 'unit-{:06d}.{}'.format(i, UNIT_TYPES[i % len(UNIT_TYPES)])
+    active, sub = ACTIVE_STATES[i % len(ACTIVE_STATES)]
+    yield name, FILE_STATES[i % len(FILE_STATES)], active, sub
+
+def generate_fixture(n):
+  """
+  Return the text and JSON output of list-unit-files and list-units.
+  """
+  units = list(generate_units(n))
+  enabled_text = ''.join(
+    '{} {} enabled\n'.format(name, state)
+    for name, state, active, sub in units
+  )
+  started_text = ''.join(
+    '{}{} loaded {} {} Generated unit {}\n'.format(
+      '● ' if active == 'failed' else '  ', name, active, sub, name
+    )
+    for name, state, active, sub in units
+  )
+  enabled_json = json.dumps([
+    {'unit_file' : name, 'state' : state, 'preset' : 'enabled'}
+    for name, state, active, sub in units
+  ])
+  started_json = json.dumps([
+    {
+      'unit' : name,
+      'load' : 'loaded',
+      'active' : active,
+      'sub' : sub,
+      'description' : 'Generated unit {}'.format(name),
+    }
+    for name, state, active, sub in units
+  ])
+  return enabled_text, started_text, enabled_json, started_json
+
+##################################### Main #####################################
+
+def bench(parse, output, number=5, repeat=3):
+  return min(timeit.repeat(
+    lambda: parse(io.StringIO(output)),
+    number=number,
+    repeat=repeat
+  )) / number
+
+def main(args=None):
+  if args is None:
+    args = sys.argv[1:]
+  try:
+    n = int(args[0])
+  except IndexError:
+    n = 20000
+
+  backend = serman.SystemctlBackend(None, [])
+  enabled_text, started_text, enabled_json, started_json = generate_fixture(n)
+
+  print('{:d} units'.format(n))
+  print('{:<20} {:>10} {:>10}'.format('query', 'text (ms)', 'json (ms)'))
+  for query, parse_text, text, parse_json, js in (
+    (
+      'list-unit-files',
+      backend.parse_enabled, enabled_text,
+      backend.parse_enabled_json, enabled_json
+    ),
+    (
+      'list-units',
+      backend.parse_started, started_text,
+      backend.parse_started_json, started_json
+    ),
+  ):
+    print('{:<20} {:>10.2f} {:>10.2f}'.format(
+      query,
+      bench(parse_text, text) * 1000,
+      bench(parse_json, js) * 1000,
+    ))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+"""
+A stand-in for the systemd manager object for testing the D-Bus backend of
+serman without systemd.
+
+It claims org.freedesktop.systemd1 on the session bus (or the given address)
+and answers the manager methods that serman uses from a set of generated units.
+Jobs finish immediately and the changes are signalled like systemd does.
+
+Usage:
+  dbus-run-session -- sh -c './fake_systemd_bus.py & sleep 1; ./serman.py --dbus session'
+
+Requires jeepney.
+"""
+
+import argparse
+import itertools
+
+import jeepney
+import jeepney.io.blocking
+
+import serman
+
+################################### Argparse ###################################
+
+argparser = argparse.ArgumentParser(
+  description='Fake systemd manager on the session bus.',
+)
+argparser.add_argument(
+  '--bus', default='SESSION', metavar='<address>',
+  help='D-Bus address to serve on. [default: session bus]'
+)
+argparser.add_argument(
+  '-n', '--units', type=int, default=50, metavar='<n>',
+  help='Number of units to generate. [default: %(default)s]'
+)
+
+################################### Manager ####################################
+
+class FakeManager(object):
+  def __init__(self, conn, n):
+    self.conn = conn
+    self.emitter = jeepney.DBusAddress(
+      serman.SYSTEMD_PATH,
+      interface=serman.SYSTEMD_MANAGER
+    )
+    self.job_ids = itertools.count(1)
+    # name -> [unit file state, load state, active state, sub state]
+    self.units = dict()
+    for i in range(n):
+      name = 'fake{:05d}.service'.format(i)
+      self.units[name] = [
+        ('enabled', 'disabled', 'static')[i % 3],
+        'loaded',
+        ('inactive', 'active')[i % 2],
+        ('dead', 'running')[i % 2],
+      ]
+    self.units['fake-failed.service'] = ['disabled', 'loaded', 'failed', 'failed']
+    self.units['fake-template@.service'] = ['disabled', 'loaded', 'inactive', 'dead']
+    self.units['fake-template@one.service'] = ['', 'loaded', 'active', 'running']
+
+  def unit_path(self, name):
+    return '{}/unit/{}'.format(
+      serman.SYSTEMD_PATH,
+      ''.join(c if c.isalnum() else '_{:02x}'.format(ord(c)) for c in name)
+    )
+
+  def unit_tuple(self, name):
+    status, loaded, active, substate = self.units.get(
+      name, ['', 'not-found', 'inactive', 'dead']
+    )
+    return (
+      name, 'Fake unit {}'.format(name), loaded, active, substate, '',
+      self.unit_path(name), 0, '', '/'
+    )
+
+  def ListUnits(self):
+    return 'a(ssssssouso)', ([
+      self.unit_tuple(name) for name in sorted(self.units)
+      if not name.endswith('@.service')
+    ],)
+
+  def ListUnitFiles(self):
+    return 'a(ss)', ([
+      ('/usr/lib/systemd/system/' + name, u[0])
+      for name, u in sorted(self.units.items()) if u[0]
+    ],)
+
+  def ListUnitsByNames(self, names):
+    return 'a(ssssssouso)', ([self.unit_tuple(name) for name in names],)
+
+  def GetUnitFileState(self, name):
+    try:
+      return 's', (self.units[name][0],)
+    except KeyError:
+      raise NoSuchUnit(name)
+
+  def Subscribe(self):
+    return None, ()
+
+  def Reload(self):
+    return None, ()
+
+  def job(self, name, active, substate):
+    unit = self.units.setdefault(name, ['', 'loaded', 'inactive', 'dead'])
+    unit[2] = active
+    unit[3] = substate
+    job_id = next(self.job_ids)
+    job = '{}/job/{:d}'.format(serman.SYSTEMD_PATH, job_id)
+    self.signals.append(jeepney.new_signal(
+      jeepney.DBusAddress(
+        self.unit_path(name),
+        interface='org.freedesktop.DBus.Properties'
+      ),
+      'PropertiesChanged',
+      'sa{sv}as',
+      (
+        serman.SYSTEMD_UNIT,
+        {
+          'LoadState' : ('s', unit[1]),
+          'ActiveState' : ('s', active),
+          'SubState' : ('s', substate),
+        },
+        []
+      )
+    ))
+    self.signals.append(jeepney.new_signal(
+      self.emitter, 'JobRemoved', 'uoss', (job_id, job, name, 'done')
+    ))
+    return 'o', (job,)
+
+  def StartUnit(self, name, mode):
+    return self.job(name, 'active', 'running')
+
+  def StopUnit(self, name, mode):
+    return self.job(name, 'inactive', 'dead')
+
+  RestartUnit = StartUnit
+  ReloadUnit = StartUnit
+  TryRestartUnit = StartUnit
+  ReloadOrRestartUnit = StartUnit
+
+  def change_unit_files(self, names, status):
+    changes = list()
+    for name in names:
+      if name not in self.units:
+        raise NoSuchUnit(name)
+      self.units[name][0] = status
+      changes.append((
+        'symlink' if status == 'enabled' else 'unlink',
+        '/etc/systemd/system/multi-user.target.wants/' + name,
+        '/usr/lib/systemd/system/' + name,
+      ))
+    self.signals.append(jeepney.new_signal(self.emitter, 'UnitFilesChanged'))
+    return changes
+
+  def EnableUnitFiles(self, names, runtime, force):
+    return 'ba(sss)', (True, self.change_unit_files(names, 'enabled'))
+
+  def DisableUnitFiles(self, names, runtime):
+    return 'a(sss)', (self.change_unit_files(names, 'disabled'),)
+
+  def handle(self, msg):
+    fields = msg.header.fields
+    if msg.header.message_type != jeepney.MessageType.method_call \
+    or fields.get(jeepney.HeaderFields.interface) != serman.SYSTEMD_MANAGER:
+      return
+    self.signals = list()
+    try:
+      method = getattr(self, fields[jeepney.HeaderFields.member])
+      signature, body = method(*msg.body)
+      reply = jeepney.new_method_return(msg, signature, body)
+    except NoSuchUnit as e:
+      reply = jeepney.new_error(
+        msg,
+        'org.freedesktop.systemd1.NoSuchUnit',
+        's',
+        ('Unit {} not found.'.format(e),)
+      )
+    except AttributeError:
+      reply = jeepney.new_error(
+        msg,
+        'org.freedesktop.DBus.Error.UnknownMethod',
+        's',
+        ('Unknown method {}'.format(fields[jeepney.HeaderFields.member]),)
+      )
+    self.conn.send(reply)
+    for signal in self.signals:
+      self.conn.send(signal)
+
+  def run(self):
+    try:
+      while True:
+        self.handle(self.conn.receive())
+    # The bus went away.
+    except ConnectionError:
+      pass
+
+
+
+class NoSuchUnit(Exception):
+  pass
+
+##################################### Main #####################################
+
+def main(args=None):
+  args = argparser.parse_args(args)
+  conn = jeepney.io.blocking.open_dbus_connection(bus=args.bus)
+  conn.send_and_get_reply(
+    jeepney.message_bus.RequestName(serman.SYSTEMD_BUS_NAME)
+  )
+  FakeManager(conn, args.units).run()
+
+if __name__ == '__main__':
+  try:
+    main()
+  except KeyboardInterrupt:
+    pass
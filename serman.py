@@ -27,21 +27,70 @@ TODO
   * clean up code
   * move most/all key bindings to external configuration file
   * move colors to external configuration file
-  * add regex and status filtering
 """
 
-import argparse
-import curses
-import curses.textpad
-import shlex
+import time
+
+# Taken first to include the imports in the startup profile.
+STARTUP_TIME = time.perf_counter()
+
+import array
+import bisect
+import collections
+import itertools
+import json
+import os
+import queue
+import re
+import select
 import subprocess
 import sys
+import threading
+
+# Modules that are only needed by some modes (curses, argparse,
+# concurrent.futures, shlex and the optional jeepney) are imported where they
+# are first used to keep startup fast.
+curses = None
+jeepney = None
 
 ################################### Globals ####################################
 
 DEFAULT_MENU_WIDTH = 10
 DEFAULT_CONSOLE_HEIGHT = 10
 
+# Milliseconds to wait for input before checking for background refreshes.
+POLL_TIMEOUT = 200
+
+# Milliseconds without further resize events before the window is laid out
+# again.
+RESIZE_DELAY = 50
+
+# Rows rendered above and below the visible rows of lists.
+SCROLL_OVERSCAN = 8
+
+# Seconds after which typing starts a new search.
+SEARCH_TIMEOUT = 1.0
+
+# Lines of command output kept in the log.
+LOG_MAX_LINES = 10000
+
+# Seconds between checks of the terminal size while the output is relayed for
+# --output-stats.
+RELAY_TIMEOUT = 0.1
+
+# ctrl+l repaints the whole screen.
+KEY_REDRAW = 0x0c
+
+# Defaults for the number of units per command and of concurrent commands.
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_MAX_WORKERS = 4
+
+# Commands that change unit files. Each call reloads the manager, so they are
+# not split into chunks.
+UNIT_FILE_COMMANDS = (
+  'enable', 'disable', 'reenable', 'preset', 'mask', 'unmask', 'link', 'revert'
+)
+
 CP_DEFAULT = 1
 CP_HIGHLIGHTED = 2
 CP_ACTIVE = 3
@@ -71,11 +120,19 @@ PREFIX_LEN = 2
 MIN_HEIGHT = 5
 HDR_COMMANDS = 'Commands'
 HDR_SERVICES = 'Services'
+# Shown while the services are loaded from the snapshot and not yet queried.
+HDR_STALE = '(updating...)'
+# Shown while only the loaded units are known.
+HDR_LOADING = '(loading unit files...)'
 MIN_HDR_WIDTH = 1 + len(HDR_COMMANDS) + len(HDR_SERVICES)
 
+# Markers printed before some unit names by list-units.
+UNIT_BULLETS = ('●', '*')
+
 MENU_COMMANDS = {
   'enable' : 'enable and disable services',
   'start' : 'start and stop services',
+  'state' : 'set whether services are enabled and running',
   'restart' : '(re)start services',
   'status' : 'query service status (display output with F2)'
 }
@@ -86,6 +143,25 @@ HELP_MSG_LEN = len(HELP_MSG)
 PARAM_PROMPT = 'Parameter: '
 PARAM_PROMPT_LEN = len(PARAM_PROMPT)
 
+FILTER_PROMPT = 'Filter: '
+FILTER_PROMPT_LEN = len(FILTER_PROMPT)
+
+# Flags of the state of units, see UnitTable.
+UNIT_ENABLED = 1
+UNIT_STATIC = 2
+UNIT_STARTED = 4
+UNIT_ERROR = 8
+UNIT_INSTANCE = 16
+
+# Filter states and the flags that hold them.
+FILTER_STATES = {
+  'active' : UNIT_STARTED,
+  'failed' : UNIT_ERROR,
+  'enabled' : UNIT_ENABLED,
+  'static' : UNIT_STATIC,
+  'instance' : UNIT_INSTANCE,
+}
+
 MIN_STATUS_WIDTH = min(len(s) for s in MENU_COMMANDS.values())
 MIN_WIDTH = min(MIN_HDR_WIDTH, MIN_STATUS_WIDTH) + PREFIX_LEN + HELP_MSG_LEN + 1
 
@@ -99,12 +175,23 @@ HELP_TEXT = '''Navigation
     * the left arrow key activates the menu
     * home and end jump to the top and bottom, resp.
     * page up and page down move up and down one screen, resp.
-    * space bar toggles the selection
-    * return or enter executes the command for the current selection
+    * a number typed before an arrow or page key repeats the move, e.g. 50
+      followed by the down arrow key moves down 50 lines
+    * space bar toggles the selection; in the state view it cycles through
+      enabled and running, enabled, running and neither
+    * return or enter executes the command for the current selection in the
+      background; the status line shows the progress and the output goes to
+      the log
+    * F8 cancels the running and queued commands
     * F3 displays this help message
     * F2 display the log
-    * entering a character will search the list for items beginning with that
-      character: lowercase searches forward, uppercase searches backwards
+    * F4 filters the services (see Filters below)
+    * ctrl+l repaints the whole screen
+    * typing searches the list for items beginning with the typed text, or
+      else containing it: characters typed in quick succession extend the
+      search, backspace shortens it and repeating a single character jumps to
+      the next item beginning with it; searches that start with a lowercase
+      character go forward, those that start with an uppercase one go backwards
 
   Text Views (F3, F2)
     * arrows keys navigate one line or column at a time
@@ -112,6 +199,18 @@ HELP_TEXT = '''Navigation
     * page up and page down move up and down one screen, resp.
     * enter returns to the main view
 
+Filters
+  A filter is a list of terms separated by spaces. Only services that match
+  all of them are shown and affected by commands. An empty filter shows all
+  services again.
+    * is:<state> matches services that are active, failed, enabled, static or
+      instances of a template, e.g. is:failed
+    * type:<type>[,<type>...] matches services of the given unit types, e.g.
+      type:timer,socket
+    * a leading "!" negates either of the above, e.g. !is:active
+    * any other terms form a regular expression that is searched for in the
+      service names, e.g. ^getty
+
 Status Symbols
   The main view uses status symbols to represent service status:
 '''
@@ -129,49 +228,348 @@ def debug(msg):
     f.write(msg)
     f.write('\n')
 
+class StartupProfile(object):
+  """
+  Time the phases of the startup, from the import of this module to the first
+  display of the services.
+  """
+  def __init__(self, start=STARTUP_TIME):
+    self.start = start
+    self.last = start
+    self.phases = list()
+
+  def mark(self, phase):
+    """
+    End the current phase.
+    """
+    now = time.perf_counter()
+    self.phases.append((phase, now - self.last))
+    self.last = now
+
+  def report(self):
+    lines = ['startup profile:']
+    for phase, seconds in self.phases:
+      lines.append('  {:<12} {:8.1f} ms'.format(phase, seconds * 1000))
+    lines.append('  {:<12} {:8.1f} ms'.format('total', (self.last - self.start) * 1000))
+    return '\n'.join(lines) + '\n'
+
+class OutputStats(object):
+  """
+  Count the bytes written to the terminal in response to each key. Once open()
+  is called, the interface runs on a pseudo-terminal whose output is relayed to
+  the terminal and counted on the way, so only what reaches the terminal is
+  counted.
+  """
+  def __init__(self):
+    self.key = None
+    self.start = 0
+    # Key name -> [keys, bytes, maximum bytes]
+    self.keys = dict()
+    self.count = 0
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def open(self):
+    """
+    Move stdin and stdout to a pseudo-terminal and start relaying it. Raise
+    OSError if they are not a terminal.
+    """
+    import termios
+    import tty
+    if not (os.isatty(0) and os.isatty(1)):
+      raise OSError('stdin and stdout are not a terminal')
+    self.tty_in = os.dup(0)
+    self.tty_out = os.dup(1)
+    self.attrs = termios.tcgetattr(self.tty_in)
+    self.master, slave = os.openpty()
+    termios.tcsetattr(slave, termios.TCSANOW, self.attrs)
+    self.size = None
+    self.copy_size()
+    os.dup2(slave, 0)
+    os.dup2(slave, 1)
+    os.close(slave)
+    # The terminal passes keys and output on as they are, except for ctrl+c,
+    # which still interrupts this process as the terminal is still its
+    # controlling terminal.
+    tty.setcbreak(self.tty_in)
+    attrs = termios.tcgetattr(self.tty_in)
+    attrs[1] &= ~termios.OPOST
+    termios.tcsetattr(self.tty_in, termios.TCSANOW, attrs)
+    os.set_blocking(self.master, False)
+    self.thread = threading.Thread(target=self.relay, daemon=True)
+    self.thread.start()
+
+  def close(self):
+    """
+    Relay the remaining output and return to the terminal.
+    """
+    import termios
+    if self.thread is None:
+      return
+    self.stopped.set()
+    self.thread.join()
+    self.flush()
+    os.dup2(self.tty_in, 0)
+    os.dup2(self.tty_out, 1)
+    termios.tcsetattr(self.tty_in, termios.TCSADRAIN, self.attrs)
+    for fd in (self.master, self.tty_in, self.tty_out):
+      os.close(fd)
+    self.thread = None
+
+  def copy_size(self):
+    """
+    Give the pseudo-terminal the size of the terminal. Return True if it
+    changed.
+    """
+    import fcntl
+    import termios
+    size = fcntl.ioctl(self.tty_out, termios.TIOCGWINSZ, b'\0' * 8)
+    if size == self.size:
+      return False
+    self.size = size
+    fcntl.ioctl(self.master, termios.TIOCSWINSZ, size)
+    return True
+
+  def relay(self):
+    import signal
+    while not self.stopped.is_set():
+      r, w, x = select.select([self.master, self.tty_in], [], [], RELAY_TIMEOUT)
+      if self.master in r:
+        self.flush()
+      if self.tty_in in r:
+        data = os.read(self.tty_in, 1024)
+        while data:
+          data = data[os.write(self.master, data):]
+      if self.copy_size():
+        # curses reads the new size when it is told about it.
+        os.kill(os.getpid(), signal.SIGWINCH)
+
+  def flush(self):
+    """
+    Relay and count the pending output.
+    """
+    with self.lock:
+      while True:
+        try:
+          data = os.read(self.master, 65536)
+        except OSError:
+          # Nothing pending, or the pseudo-terminal is closed.
+          return
+        if not data:
+          return
+        self.count += len(data)
+        while data:
+          data = data[os.write(self.tty_out, data):]
+
+  def written(self):
+    """
+    Return the number of bytes written to the terminal so far.
+    """
+    self.flush()
+    return self.count
+
+  def key_pressed(self, c):
+    """
+    Start counting the output for a key.
+    """
+    self.stop()
+    try:
+      self.key = curses.keyname(c).decode('utf-8', 'replace')
+    except ValueError:
+      self.key = str(c)
+    self.start = self.written()
+
+  def stop(self):
+    """
+    Stop counting the output for the current key, if any.
+    """
+    if self.key is None:
+      return
+    n = self.written() - self.start
+    stats = self.keys.setdefault(self.key, [0, 0, 0])
+    stats[0] += 1
+    stats[1] += n
+    stats[2] = max(stats[2], n)
+    self.key = None
+
+  def report(self):
+    lines = ['terminal output per key:']
+    total = [0, 0, 0]
+    for key, (n, written, most) in sorted(self.keys.items()):
+      lines.append('  {:<12} {:6d} keys {:10d} bytes {:10.1f} average {:8d} max'.format(
+        key, n, written, written / n, most
+      ))
+      total = [total[0] + n, total[1] + written, max(total[2], most)]
+    if total[0]:
+      lines.append('  {:<12} {:6d} keys {:10d} bytes {:10.1f} average {:8d} max'.format(
+        'total', total[0], total[1], total[1] / total[0], total[2]
+      ))
+    return '\n'.join(lines) + '\n'
 
-################################### Argparse ###################################
-argparser = argparse.ArgumentParser(
-  description='Ncurses-based systemd service manager.',
-  epilog='Press F3 while running %(prog)s for more help.',
-)
-
-group = argparser.add_argument_group(title='Systemd', description=None)
-group.add_argument(
-  '-b', '--bin', default='/usr/bin/systemctl', metavar='<path>',
-  help='Path to the systemctl binary. [default: %(default)s]'
-)
-group.add_argument(
-  '-a', '--args', nargs=argparse.REMAINDER, default=[],
-  help='Pass remaining arguments directly to systemctl (e.g. --user).'
-)
-# argparser.add_argument(
-#   '--dry-run', action='store_true',
-#   help='Print systemctl command instead of running them.'
-# )
-
-group = argparser.add_argument_group(title='Commands', description=None)
-group.add_argument(
-  '-c', '--command', action='append', metavar='<unit command>', default=[],
-  help='Additional systemctl commands to add to the menu.'
-)
-
-group = argparser.add_argument_group(title='Aesthetics', description=None)
-group.add_argument(
-  '--on', metavar='<string>', default=PREFIX_ON,
-  help='Prefix to use to indicate selected services. Default: "%(default)s".'
-)
-
-group.add_argument(
-  '--off', metavar='<string>', default=PREFIX_OFF,
-  help='Prefix to use to indicate unselected services. Default: "%(default)s".'
-)
 
-group = argparser.add_argument_group(title='Miscellaneous', description=None)
-group.add_argument(
-  '--debug', metavar='<path>',
-  help='Path to a debug log file.'
-)
+################################### Argparse ###################################
+def add_backend_arguments(group):
+  group.add_argument(
+    '-b', '--bin', default='/usr/bin/systemctl', metavar='<path>',
+    help='Path to the systemctl binary. [default: %(default)s]'
+  )
+  group.add_argument(
+    '--no-json', dest='json', action='store_false',
+    help='Parse the plain text output of systemctl even if it supports JSON.'
+  )
+  group.add_argument(
+    '--dbus', nargs='?', const='auto', metavar='<bus>',
+    help=(
+      'Talk to the systemd manager over D-Bus (requires jeepney) instead of '
+      'running systemctl for each query and command. <bus> may be "system", '
+      '"session" or a D-Bus address. By default the session bus is used with '
+      '--user and the system bus otherwise.'
+    )
+  )
+
+def build_argparser():
+  import argparse
+
+  argparser = argparse.ArgumentParser(
+    description='Ncurses-based systemd service manager.',
+    epilog=(
+      'Press F3 while running %(prog)s for more help. Run "%(prog)s apply -h" '
+      'for applying a state file without the interface.'
+    ),
+  )
+
+  group = argparser.add_argument_group(title='Systemd', description=None)
+  add_backend_arguments(group)
+  group.add_argument(
+    '-r', '--refresh', type=float, metavar='<seconds>',
+    help='Query systemd in the background every <seconds> and update the display.'
+  )
+  group.add_argument(
+    '-w', '--watch', action='store_true',
+    help=(
+      'Follow unit state changes as systemd reports them (manager signals with '
+      '--dbus, the journal otherwise) and update the display.'
+    )
+  )
+  group.add_argument(
+    '--no-cache', dest='cache', action='store_false',
+    help=(
+      'Wait for systemd at startup instead of showing the services as they were '
+      'when %(prog)s last exited while it is queried.'
+    )
+  )
+  group.add_argument(
+    '-a', '--args', nargs=argparse.REMAINDER, default=[],
+    help='Pass remaining arguments directly to systemctl (e.g. --user).'
+  )
+  # argparser.add_argument(
+  #   '--dry-run', action='store_true',
+  #   help='Print systemctl command instead of running them.'
+  # )
+
+  group = argparser.add_argument_group(title='Commands', description=None)
+  group.add_argument(
+    '-c', '--command', action='append', metavar='<unit command>', default=[],
+    help='Additional systemctl commands to add to the menu.'
+  )
+  group.add_argument(
+    '-t', '--timeout', type=float, metavar='<seconds>',
+    help='Cancel commands that take longer than <seconds>. [default: never]'
+  )
+  group.add_argument(
+    '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, metavar='<n>',
+    help=(
+      'Split commands for many units into commands for at most <n> units each. '
+      'Commands that change unit files, such as enable, are not split as each '
+      'one reloads the manager. [default: %(default)s]'
+    )
+  )
+  group.add_argument(
+    '-j', '--jobs', dest='max_workers', type=int, default=DEFAULT_MAX_WORKERS, metavar='<n>',
+    help='Run at most <n> of the split commands at a time. [default: %(default)s]'
+  )
+
+  group = argparser.add_argument_group(title='Aesthetics', description=None)
+  group.add_argument(
+    '--on', metavar='<string>', default=PREFIX_ON,
+    help='Prefix to use to indicate selected services. Default: "%(default)s".'
+  )
+
+  group.add_argument(
+    '--off', metavar='<string>', default=PREFIX_OFF,
+    help='Prefix to use to indicate unselected services. Default: "%(default)s".'
+  )
+
+  group = argparser.add_argument_group(title='Miscellaneous', description=None)
+  group.add_argument(
+    '--debug', metavar='<path>',
+    help='Path to a debug log file.'
+  )
+  group.add_argument(
+    '--startup-profile', action='store_true',
+    help=(
+      'Print the time taken until the first display of the services, split '
+      'into its phases, to stderr on exit.'
+    )
+  )
+  group.add_argument(
+    '--output-stats', action='store_true',
+    help=(
+      'Count the bytes written to the terminal in response to each key and '
+      'print the counts per key to stderr on exit. The output is relayed '
+      'through a pseudo-terminal to count it.'
+    )
+  )
+  return argparser
+
+
+def build_apply_argparser():
+  import argparse
+
+  apply_argparser = argparse.ArgumentParser(
+    prog='serman apply',
+    description=(
+      'Bring systemd units to the state given in a JSON file without the '
+      'interface and print a JSON report. The file contains an object with lists '
+      'of units under any of the keys "enabled", "disabled", "started" and '
+      '"stopped". The exit status is 1 if the state could not be reached.'
+    ),
+  )
+  apply_argparser.add_argument(
+    'statefile', metavar='<statefile>',
+    help='Path to the state file, or "-" for stdin.'
+  )
+
+  group = apply_argparser.add_argument_group(title='Systemd', description=None)
+  add_backend_arguments(group)
+  group.add_argument(
+    '-a', '--args', nargs=argparse.REMAINDER, default=[],
+    help='Pass remaining arguments directly to systemctl (e.g. --user).'
+  )
+
+  group = apply_argparser.add_argument_group(title='Commands', description=None)
+  group.add_argument(
+    '-n', '--dry-run', action='store_true',
+    help='Report the commands that would be run without running them.'
+  )
+  group.add_argument(
+    '-t', '--timeout', type=float, metavar='<seconds>',
+    help='Cancel commands that take longer than <seconds>. [default: never]'
+  )
+  group.add_argument(
+    '--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, metavar='<n>',
+    help=(
+      'Split commands for many units into commands for at most <n> units each. '
+      'Commands that change unit files, such as enable, are not split as each '
+      'one reloads the manager. [default: %(default)s]'
+    )
+  )
+  group.add_argument(
+    '-j', '--jobs', dest='max_workers', type=int, default=1, metavar='<n>',
+    help='Run at most <n> of the split commands at a time. [default: %(default)s]'
+  )
+  return apply_argparser
 
 
 
@@ -243,18 +641,114 @@ def ignore_curses_errors(f):
 
 
 
+class SearchIndex(object):
+  """
+  Case-insensitive lookups of items by prefix or, failing that, by substring.
+
+  Prefixes are found by bisection of the sorted lowercased items and their rows.
+  These are the items themselves unless the case-sensitive order of the items
+  differs, e.g. because capitalized ones come first. Substrings of at least
+  three characters are found through an index of the trigrams of each item,
+  which is built on the first substring search.
+  """
+
+  def __init__(self, items):
+    self.items = items
+    self.keys = [item.lower() for item in items]
+    self.ordered = all(a <= b for a, b in zip(self.keys, self.keys[1:]))
+    if self.ordered:
+      self.sorted_keys = self.keys
+      self.sorted_rows = None
+    else:
+      self.sorted_rows = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+      self.sorted_keys = [self.keys[i] for i in self.sorted_rows]
+    self.trigrams = None
+
+  def prefix_rows(self, key):
+    lo = bisect.bisect_left(self.sorted_keys, key)
+    hi = bisect.bisect_left(self.sorted_keys, key[:-1] + chr(ord(key[-1]) + 1), lo)
+    if self.ordered:
+      return range(lo, hi)
+    # The rows of a prefix are mostly in order, which sorted() handles in
+    # linear time.
+    return sorted(self.sorted_rows[lo:hi])
+
+  def substring_rows(self, key):
+    """
+    Return the sorted rows that may contain the key: those of the rarest
+    trigram of the key, or all rows for shorter keys.
+    """
+    if len(key) < 3:
+      return range(len(self.keys))
+    if self.trigrams is None:
+      self.trigrams = collections.defaultdict(list)
+      for i, k in enumerate(self.keys):
+        for trigram in set(k[j:j+3] for j in range(len(k) - 2)):
+          self.trigrams[trigram].append(i)
+    return min(
+      (self.trigrams.get(key[j:j+3], ()) for j in range(len(key) - 2)),
+      key=len
+    )
+
+  def find(self, key, start, backwards=False):
+    """
+    Return the first matching row at or after start, wrapping around, or at or
+    before it when searching backwards. None is returned if nothing matches.
+    """
+    rows = self.prefix_rows(key)
+    if rows:
+      if backwards:
+        i = bisect.bisect_right(rows, start) - 1
+        return rows[i]
+      else:
+        i = bisect.bisect_left(rows, start)
+        if i < len(rows):
+          return rows[i]
+        else:
+          return rows[0]
+
+    rows = self.substring_rows(key)
+    n = len(rows)
+    if backwards:
+      i = bisect.bisect_right(rows, start) - 1
+      order = itertools.chain(range(i, -1, -1), range(n - 1, i, -1))
+    else:
+      i = bisect.bisect_left(rows, start)
+      order = itertools.chain(range(i, n), range(0, i))
+    for j in order:
+      if key in self.keys[rows[j]]:
+        return rows[j]
+    return None
+
+
+
 class Scrollpad(object):
+  """
+  A scrollable list of items. Only the visible rows and a few rows of overscan
+  on either side are rendered, to a pad that starts at item pad_top.
+  """
+
   def __init__(self, window, *args, **kwargs): #items, current=0, position=0):
     self.window = window
     self.pad = curses.newpad(1, 1)
     self.current = 0
     self.position = 0
+    self.pad_top = 0
+    self.vis_x = 0
+    self.vis_y = 0
+    self.vis_w = 0
+    self.vis_h = 0
+    self.query = ''
+    self.query_time = 0
+    self.backwards = False
+    self._search_index = None
+    # Digits of a repeat count for the next move.
+    self.count = ''
     self.configure(*args, **kwargs)
 
   @ignore_curses_errors
   def draw(self, nout=True, fill=True):
     if fill:
-#       self.pad.clear()
       self.fill()
     self.change_position()
     if nout:
@@ -262,7 +756,7 @@ class Scrollpad(object):
     else:
       refresh = self.pad.refresh
     refresh(
-      self.position,
+      self.position - self.pad_top,
       0,
       self.vis_y,
       self.vis_x,
@@ -270,30 +764,85 @@ class Scrollpad(object):
       self.vis_x + min(self.w, self.vis_w) - 1,
     )
 
+  @property
+  def pad_rows(self):
+    # The refreshed area spans vis_h + 1 rows.
+    return self.vis_h + 1 + 2 * SCROLL_OVERSCAN
+
+  def pad_row(self, i):
+    """
+    Return the pad row of item i, or None if it is not rendered.
+    """
+    row = i - self.pad_top
+    if 0 <= row < self.pad_rows:
+      return row
+    else:
+      return None
+
   def change_item(self, i, cp):
+    row = self.pad_row(i)
+    if row is None:
+      return
     self.pad.addstr(
-      i, 0,
+      row, 0,
       self.items[i].ljust(self.w),
       curses.color_pair(cp)
     )
 
-  def fill(self):
-    for i in range(len(self.items)):
-      if i == self.current:
-        if self.window.active == self:
-          cp = CP_ACTIVE
-        else:
-          cp = CP_HIGHLIGHTED
+  def item_cp(self, i):
+    if i == self.current:
+      if self.window.active == self:
+        return CP_ACTIVE
       else:
-        cp = CP_DEFAULT
-      self.change_item(i, cp)
+        return CP_HIGHLIGHTED
+    else:
+      return CP_DEFAULT
+
+  def resize_pad(self):
+    self.pad.resize(self.pad_rows + 1, self.w)
+
+  def set_items(self, items, shared=False):
+    """
+    Set the sorted items. Shared items are copied before they are modified.
+    """
+    self.items = items
+    self.shared = shared
+    self.h = len(items)
+
+  def find_item(self, item):
+    """
+    Return the position of an item, or raise KeyError if it is not listed.
+    """
+    i = bisect.bisect_left(self.items, item)
+    if i == len(self.items) or self.items[i] != item:
+      raise KeyError(item)
+    return i
+
+  def insert_item(self, item):
+    """
+    Insert a new item in sorted order and return its position.
+    """
+    if self.shared:
+      self.items = list(self.items)
+      self.shared = False
+    i = bisect.bisect_left(self.items, item)
+    self.items.insert(i, item)
+    self.h = len(self.items)
+    # The items were changed in place.
+    self._search_index = None
+    return i
+
+  def fill(self):
+    self.pad.erase()
+    for i in range(self.pad_top, min(self.h, self.pad_top + self.pad_rows)):
+      self.change_item(i, self.item_cp(i))
 
   def change_current(self, dx):
     next = self.current + dx
     if next < 0:
       next = 0
     elif next >= self.h:
-      next = self.h - 1
+      next = max(0, self.h - 1)
     if self.current != next:
       self.change_item(self.current, CP_DEFAULT)
       previous = self.current
@@ -309,53 +858,175 @@ class Scrollpad(object):
       self.position = self.current - self.vis_h
     elif self.h <= self.position + self.vis_h:
       self.position = max(0, self.h - self.vis_h)
+    # Render another window of rows once the view leaves the rendered one.
+    if self.position < self.pad_top \
+    or self.position + self.vis_h >= self.pad_top + self.pad_rows:
+      self.pad_top = max(0, self.position - SCROLL_OVERSCAN)
+      self.fill()
 
-  def jump_to_chr(self, c):
-    item = self.items[self.current]
-    c = chr(c)
-    lc = c.lower()
-    if c == lc:
-      di = 1
-      rng = range(self.h)
+  @property
+  def search_index(self):
+    # Rebuilt only when the items change.
+    if self._search_index is None or self._search_index.items is not self.items:
+      self._search_index = SearchIndex(self.items)
+    return self._search_index
+
+  def search(self, c):
+    """
+    Incremental type-ahead search. Characters typed within SEARCH_TIMEOUT
+    seconds of each other extend the query and backspace shortens it. Typing
+    the same character repeatedly jumps to the next item that begins with it. A
+    query that starts with an uppercase character searches backwards.
+
+    Return False if the key is not part of a search.
+    """
+    now = time.monotonic()
+    if now - self.query_time > SEARCH_TIMEOUT:
+      self.query = ''
+    if c in (curses.KEY_BACKSPACE, 127, 8):
+      if not self.query:
+        return False
+      query = self.query[:-1]
     else:
-      c = lc
+      try:
+        ch = chr(c)
+      except ValueError:
+        return False
+      if c > 255 or not ch.isprintable():
+        return False
+      if not self.query:
+        self.backwards = ch.isupper()
+      query = self.query + ch
+    self.query_time = now
+
+    if not query:
+      self.end_search()
+      return True
+
+    key = query.lower()
+    if self.backwards:
       di = -1
-      rng = range(self.h-1, 0, di)
-    if item[0].lower() == c:
-      next = self.items[self.current + di]
-      if next[0].lower() == c:
-        self.change_current(di)
-        return
-    for i in rng:
-      if self.items[i][0].lower() == c:
-        self.change_current(i - self.current)
-        return
+    else:
+      di = 1
+    start = self.current
+    # Cycle through the items beginning with a repeated character.
+    if len(key) > 1 and key == key[0] * len(key):
+      key = key[0]
+      start = (self.current + di) % max(self.h, 1)
+    i = self.search_index.find(key, start, backwards=self.backwards)
+
+    if i is not None:
+      self.query = query
+      self.window.update_status(
+        nout=False,
+        line='Search: ' + query,
+        cp=curses.color_pair(CP_ENABLED)
+      )
+      self.change_current(i - self.current)
+    return True
+
+  def end_search(self):
+    if self.query:
+      self.query = ''
+      self.window.update_status(nout=False)
+
+  def add_count(self, c):
+    """
+    Add a digit to the repeat count. Return False if the key is not part of a
+    count. Digits typed during a search extend the search instead.
+    """
+    if self.query or not ord('0') <= c <= ord('9') or (c == ord('0') and not self.count):
+      return False
+    self.count += chr(c)
+    self.window.update_status(
+      nout=False,
+      line='Count: ' + self.count,
+      cp=curses.color_pair(CP_ENABLED)
+    )
+    return True
+
+  def end_count(self, move):
+    """
+    Return the repeat count and reset it. The digits are searched for instead if
+    the count is not followed by a move.
+    """
+    count, self.count = self.count, ''
+    if not count:
+      return 1
+    self.window.update_status(nout=False)
+    if not move:
+      for ch in count:
+        self.search(ord(ch))
+    return int(count)
+
+  def move_delta(self, c):
+    """
+    Return the number of items by which a key moves the current one, or None.
+    """
+    if c == curses.KEY_UP:
+      return -1
+    elif c == curses.KEY_DOWN:
+      return 1
+    elif c == curses.KEY_PPAGE:
+      return -self.vis_h
+    elif c == curses.KEY_NPAGE:
+      return self.vis_h
+    elif c == curses.KEY_HOME:
+      return -self.h
+    elif c == curses.KEY_END:
+      return self.h
+    else:
+      return None
+
+  def move(self, c, count=1):
+    """
+    Move by the given key count times and by the move keys that are already
+    queued behind it, e.g. while a key is held down over a slow connection, so
+    that the list is repainted once. The first other key is put back.
+    """
+    stdscr = self.window.stdscr
+    target = max(0, min(self.current + self.move_delta(c) * count, self.h - 1))
+    stdscr.timeout(0)
+    try:
+      while True:
+        c = stdscr.getch()
+        delta = self.move_delta(c)
+        if delta is None:
+          break
+        if self.window.output is not None:
+          self.window.output.key_pressed(c)
+        target = max(0, min(target + delta, self.h - 1))
+    finally:
+      stdscr.timeout(POLL_TIMEOUT)
+    if c != curses.ERR:
+      curses.ungetch(c)
+    self.change_current(target - self.current)
 
   def run(self):
     ret = None
     run = True
     self.change_item(self.current, CP_ACTIVE)
+    output = self.window.output
     while run:
       self.draw(nout=False, fill=False)
+      if output is not None:
+        output.stop()
       c = self.window.stdscr.getch()
 
-      if c == curses.KEY_UP:
-        self.change_current(-1)
-
-      elif c == curses.KEY_DOWN:
-        self.change_current(1)
-
-      elif c == curses.KEY_PPAGE:
-        self.change_current(-self.vis_h)
-
-      elif c == curses.KEY_NPAGE:
-        self.change_current(self.vis_h)
+      # getch() times out periodically when background refreshes are enabled.
+      if c == curses.ERR:
+        self.window.poll()
+        continue
+      if output is not None:
+        output.key_pressed(c)
 
-      elif c == curses.KEY_HOME:
-        self.change_current(-self.h)
+      if self.add_count(c):
+        continue
+      is_move = self.move_delta(c) is not None
+      count = self.end_count(is_move)
 
-      elif c == curses.KEY_END:
-        self.change_current(self.h)
+      if is_move:
+        self.move(c, count)
 
       elif c == curses.KEY_F3:
         self.window.display_text('help')
@@ -363,15 +1034,24 @@ class Scrollpad(object):
       elif c == curses.KEY_F2:
         self.window.display_text('log')
 
+      elif c == curses.KEY_F4:
+        self.window.edit_filter()
+
+      elif c == curses.KEY_F8:
+        self.window.jobs.cancel()
+
       elif c == curses.KEY_RESIZE:
-        self.window.configure()
-        self.window.update()
-        self.window.draw()
+        self.window.resize()
+
+      elif c == KEY_REDRAW:
+        self.window.redraw()
 
       else:
         ret, run = self.handle_key(c)
-        if ret is None:
-          self.jump_to_chr(c)
+        if ret is None and self.search(c):
+          continue
+
+      self.end_search()
 
     self.change_item(self.current, CP_HIGHLIGHTED)
     self.draw(nout=False, fill=False)
@@ -382,7 +1062,7 @@ class Scrollpad(object):
 class Menu(Scrollpad):
 
   def configure(self, choices, current=None, position=None):
-    self.items = choices
+    self.set_items(choices)
     if current is not None:
       self.current = current
     if position is not None:
@@ -390,7 +1070,7 @@ class Menu(Scrollpad):
     self.w = max(len(x) for x in choices)
     self.w = max(self.w, len(HDR_COMMANDS))
     self.h = len(choices)
-    self.pad.resize(self.h+1, self.w)
+    self.resize_pad()
 
   def handle_key(self, c):
     if c == curses.KEY_RIGHT:
@@ -403,100 +1083,142 @@ class Menu(Scrollpad):
 
 class Checklist(Scrollpad):
 
+  def __init__(self, window, *args, **kwargs):
+    self.checklist = dict()
+    self.items = list()
+    # Maps units to the key and the runs of their last rendered row.
+    self.render_cache = dict()
+    # The width of the widest row, which is padded to the visible width.
+    self.content_w = 1
+    super().__init__(window, *args, **kwargs)
+
+  def resize_pad(self):
+    self.w = max(self.content_w, self.vis_w)
+    super().resize_pad()
+
   def configure(self, checklist, current=None, position=None, print_status=False):
     self.print_status = print_status
     self.update_items(checklist)
     if current is not None:
       if isinstance(current, str):
-        current = self.items.index(current)
+        current = self.find_item(current)
       self.current = current
     if position is not None:
       self.position = position
 
   def update_items(self, checklist):
+    previous = self.checklist
     self.checklist = checklist
     if checklist:
-      self.w = max(len(x) for x in checklist) + PREFIX_LEN
+      self.content_w = max(len(x) for x in checklist) + self.window.prefix_len()
       if self.print_status:
         self.status_len = self.window.print_status(None, None, None, None, return_max=True)
-        self.w += self.status_len
+        self.content_w += self.status_len
       else:
         self.status_len = 0
     else:
-      self.w = 1
-    try:
-      self.w = max(self.w, self.vis_w)
-    except AttributeError:
-      pass
-    self.h = len(checklist)
-    self.pad.resize(self.h+1, self.w)
-    self.items = sorted(self.checklist)
+      self.content_w = 1
+    self.resize_pad()
+    # Reuse the sorted units from Systemd unless units were added or filtered,
+    # and the current ones if only the selection changed.
+    items, index = self.window.systemd.sorted_services()
+    if checklist.keys() == index.keys():
+      self.set_items(items, shared=True)
+    elif checklist.keys() == previous.keys():
+      self.set_items(self.items, self.shared)
+    else:
+      self.set_items(sorted(checklist))
 
   def change_item(self, i, cp):
-    if self.checklist:
+    row = self.pad_row(i)
+    if self.checklist and row is not None:
       item = self.items[i]
       try:
-        if self.checklist[item]:
-          is_static = self.window.systemd.is_static(item)
-          prefix, cp_prefix = self.window.get_checkbox(is_static=is_static)
-        else:
-          prefix = PREFIX_OFF
-          cp_prefix = CP_OFF
+        selected = self.checklist[item]
       except KeyError:
-        self.checklist[item] = False
-        prefix = PREFIX_OFF
-        cp_prefix = CP_OFF
-      prefix_len = len(prefix)
-      self.pad.addstr(
-        i,
-        0,
-        prefix,
-        curses.color_pair(cp_prefix)
-      )
-      self.pad.addstr(
-        i,
-        prefix_len,
-        item.ljust(self.w - (prefix_len + self.status_len), ' '),
-        curses.color_pair(cp)
+        selected = self.checklist[item] = False
+      # Everything that the row depends on besides the constant prefixes.
+      systemd = self.window.systemd
+      key = (
+        selected,
+        cp,
+        systemd.units.get(item),
+        systemd.units.sub(item),
+        systemd.sub_len,
+        self.w,
+        self.print_status,
+        self.window.menu.current,
       )
-      if self.print_status:
-        self.window.print_status(
-          item,
-          self.pad,
-          i,
-          self.w - self.status_len
-        )
+      try:
+        cached_key, runs = self.render_cache[item]
+      except KeyError:
+        cached_key = None
+      if cached_key != key:
+        runs = self.render_item(item, selected, cp)
+        self.render_cache[item] = (key, runs)
+      for x, string, attr in runs:
+        self.pad.addstr(row, x, string, attr)
+
+  def render_item(self, item, selected, cp):
+    """
+    Return the row of an item as (x, string, attribute) runs, joining adjacent
+    segments of the same color.
+    """
+    if isinstance(selected, tuple):
+      segments = self.window.get_state_checkbox(item, *selected)
+    elif selected:
+      is_static = self.window.systemd.is_static(item)
+      segments = [self.window.get_checkbox(is_static=is_static)]
+    else:
+      segments = [(PREFIX_OFF, CP_OFF)]
+    prefix_len = sum(len(string) for string, _ in segments)
+    segments.append(
+      (item.ljust(self.w - (prefix_len + self.status_len), ' '), cp)
+    )
+    if self.print_status:
+      segments.extend(self.window.status_segments(item))
+    runs = list()
+    x = 0
+    for string, cp in segments:
+      if runs and runs[-1][2] == cp:
+        runs[-1][1] += string
+      else:
+        runs.append([x, string, cp])
+      x += len(string)
+    return [(x, string, curses.color_pair(cp)) for x, string, cp in runs]
 
   def add_or_update_item(self, item):
     # Just update the item if it already exists.
     try:
-      self.checklist[item] = (not self.checklist[item])
-      self.current = self.items.index(item)
+      self.checklist[item] = self.window.toggle(item, self.checklist[item])
+      self.current = self.find_item(item)
       self.change_item(self.current, CP_ACTIVE)
     except KeyError:
-      self.checklist[item] = True
-      self.configure(
-        self.checklist,
-        current=item,
-        position=self.position,
-        print_status=self.print_status,
-      )
+      command = self.window.menu.items[self.window.menu.current]
+      self.checklist[item] = self.window.toggle(item, self.window.is_checked(command, item))
+      self.current = self.insert_item(item)
+      w = len(item) + self.window.prefix_len() + self.status_len
+      if w > self.w:
+        self.w = w
+        self.resize_pad()
       self.draw()
 
-  def prompt(self, msg):
+  def prompt(self, msg, line=PARAM_PROMPT, text=''):
     self.window.update_status(
       nout=False,
-        line=PARAM_PROMPT,
+        line=line,
         cp=curses.color_pair(CP_ENABLED),
         help=False
       )
 
     win = curses.newwin(
       1,
-      self.window.w-PARAM_PROMPT_LEN,
+      self.window.w-len(line),
       self.window.h-1,
-      PARAM_PROMPT_LEN
+      len(line)
     )
+    if text:
+      win.addstr(0, 0, text[:self.window.w-len(line)-1])
     textbox = curses.textpad.Textbox(win)
     # There is always a trailing space for some reason. The "strip" method could
     # probably be used here but someone may actually want to use leading and/or
@@ -511,7 +1233,7 @@ class Checklist(Scrollpad):
     if c == curses.KEY_LEFT:
       return self.window.menu, False
 
-    elif c == ord(' '):
+    elif c == ord(' ') and self.items:
       item = self.items[self.current]
       command = self.window.menu.items[self.window.menu.current]
 
@@ -521,7 +1243,7 @@ class Checklist(Scrollpad):
         self.add_or_update_item(new_item)
 
       elif not (command == 'enable' and self.window.systemd.is_static(item)):
-        self.checklist[item] = (not self.checklist[item])
+        self.checklist[item] = self.window.toggle(item, self.checklist[item])
         self.change_item(self.current, CP_ACTIVE)
 
       return True, True
@@ -539,14 +1261,23 @@ class StatusLine(object):
   def __init__(self, window, status):
     self.window = window
     self.pad = curses.newpad(1,1)
+    self.key = None
+    self.w = 0
     self.configure(status)
 
   def configure(self, status, cp=None, help=True):
-    self.status = status
-    self.w = max(1, len(status), self.window.w)
-    self.pad.resize(1, self.w+1)
     if cp is None:
       cp = curses.color_pair(CP_DEFAULT)
+    # The status is configured on every move, usually without changes.
+    key = (status, cp, help, self.window.w)
+    if key == self.key:
+      return
+    self.key = key
+    self.status = status
+    w = max(1, len(status), self.window.w)
+    if w != self.w:
+      self.w = w
+      self.pad.resize(1, self.w+1)
     self.pad.addstr(
       0,
       0,
@@ -580,12 +1311,86 @@ class StatusLine(object):
 
 
 
+class LogBuffer(object):
+  """
+  The last lines of command output. Once max_lines lines have been logged, new
+  lines overwrite the oldest ones so the log stays bounded in long sessions.
+  Lines are indexed from the oldest one.
+  """
+
+  def __init__(self, max_lines=LOG_MAX_LINES):
+    self.max_lines = max_lines
+    self.lines = list()
+    self.start = 0
+    # The width of the widest line logged so far.
+    self.width = 0
+
+  def write(self, text):
+    """
+    Append text to the log as if it were written to a stream, i.e. the text up
+    to the first newline continues the last line.
+    """
+    first, *rest = text.split('\n')
+    if self.lines:
+      i = (self.start + len(self.lines) - 1) % len(self.lines)
+      self.lines[i] += first
+      self.width = max(self.width, len(self.lines[i]))
+    else:
+      self.add_line(first)
+    for line in rest:
+      self.add_line(line)
+
+  def add_line(self, line):
+    if len(self.lines) < self.max_lines:
+      self.lines.append(line)
+    else:
+      self.lines[self.start] = line
+      self.start = (self.start + 1) % self.max_lines
+    self.width = max(self.width, len(line))
+
+  def __len__(self):
+    return len(self.lines)
+
+  def __getitem__(self, i):
+    if not 0 <= i < len(self.lines):
+      raise IndexError(i)
+    return self.lines[(self.start + i) % len(self.lines)]
+
+
+
 class Window(object):
-  def __init__(self, stdscr, systemd):
+  def __init__(
+    self,
+    stdscr,
+    systemd,
+    refresh=None,
+    watch=False,
+    timeout=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    max_workers=DEFAULT_MAX_WORKERS,
+    profile=None,
+    output=None
+  ):
     self.stdscr = stdscr
     self.systemd = systemd
+    self.refresh_interval = refresh
+    self.watch = watch
+    self.timeout = timeout
+    self.profile = profile
+    self.output = output
+    self.jobs = JobRunner(
+      systemd,
+      BatchExecutor(systemd, chunk_size=chunk_size, max_workers=max_workers)
+    )
+    self.updaters = [self.jobs]
+    # True while the status line shows an error of an updater.
+    self.updater_error = False
+    self.progress = None
+    self.filter = None
     self.h, self.w = self.stdscr.getmaxyx()
-    self.log = ''
+    self.log = LogBuffer()
+    # Let curses scroll the terminal instead of repainting the scrolled lines.
+    self.stdscr.idlok(True)
 
     self.menu = Menu(self, sorted(MENU_COMMANDS))
     self.checklist = Checklist(self, dict())
@@ -599,7 +1404,7 @@ class Window(object):
     self.h, self.w = self.stdscr.getmaxyx()
 
     while self.h < MIN_HEIGHT or self.w < MIN_WIDTH:
-      self.stdscr.clear()
+      self.stdscr.erase()
       while self.stdscr.getch() != curses.KEY_RESIZE:
         pass
       self.h, self.w = self.stdscr.getmaxyx()
@@ -618,37 +1423,148 @@ class Window(object):
     self.checklist.vis_y = 2
     self.checklist.vis_w = max(self.w - self.checklist.vis_x, 0)
     self.checklist.vis_h = self.menu.vis_h
+    self.menu.resize_pad()
+    self.checklist.resize_pad()
 
   def update(self, previous=None):
     if self.active == self.menu:
       command = self.update_status(nout=False)
+      self.checklist.configure(
+        self.checklist_dict(command),
+        print_status=True
+      )
+      self.checklist.draw(nout=False)
 
-      if command == 'enable':
-        self.checklist.configure(
-          self.systemd.as_dict(self.systemd.enabled | self.systemd.static),
-          print_status=True
-        )
+  def checklist_dict(self, command):
+    """
+    Return the initial checklist for the command. The checklists are cached by
+    Systemd until the state changes and copied here because the selection is
+    edited in place.
+    """
+    if command not in ('enable', 'start', 'state'):
+      command = None
+    if self.filter is None:
+      expression = None
+    else:
+      expression = self.filter.expression
+    return dict(self.systemd.cached(
+      ('checklist', command, expression),
+      lambda: self.build_checklist_dict(command)
+    ))
+
+  def build_checklist_dict(self, command):
+    if self.filter is None:
+      units = None
+    else:
+      units = self.filter.units(self.systemd)
+    if command in ('enable', 'state') and self.systemd.loading:
+      # Nothing is known about the unit files yet.
+      return dict()
+    if command == 'enable':
+      return self.systemd.as_dict(self.systemd.select(UNIT_ENABLED | UNIT_STATIC), units)
+    elif command == 'start':
+      return self.systemd.as_dict(self.systemd.select(UNIT_STARTED), units)
+    elif command == 'state':
+      table = self.systemd.units
+      if units is None:
+        units = table.names
+      return dict(
+        (unit, (bool(flags & (UNIT_ENABLED | UNIT_STATIC)), bool(flags & UNIT_STARTED)))
+        for unit, flags in zip(units, map(table.get, units))
+      )
+    else:
+      return self.systemd.as_dict(units=units)
 
-      elif command == 'start':
-        self.checklist.configure(
-          self.systemd.as_dict(self.systemd.started),
-          print_status=True
-        )
+  def is_shown(self, unit):
+    """
+    Return True if the unit belongs in the checklist with the current filter.
+    """
+    if unit not in self.systemd.units:
+      return False
+    return self.filter is None or unit in self.filter.units(self.systemd)
 
-      else:
-        print_status = True
-        self.checklist.configure(
-          self.systemd.as_dict(),
-          print_status=print_status
+  def edit_filter(self):
+    if self.filter is None:
+      text = ''
+    else:
+      text = self.filter.expression
+    expression = self.checklist.prompt(
+      'Filter', line=FILTER_PROMPT, text=text
+    ).strip()
+    if expression:
+      try:
+        unit_filter = UnitFilter(expression)
+      except ValueError as e:
+        self.update_status(
+          nout=False,
+          line='invalid filter: {}'.format(e),
+          cp=curses.color_pair(CP_OFF)
         )
+        return
+    else:
+      unit_filter = None
+    self.filter = unit_filter
+    command = self.menu.items[self.menu.current]
+    self.checklist.configure(
+      self.checklist_dict(command),
+      current=0,
+      position=0,
+      print_status=self.checklist.print_status
+    )
+    self.configure()
+    self.draw()
+    self.update_status(nout=False)
 
-      self.checklist.draw(nout=False)
+  def is_checked(self, command, unit):
+    """
+    Return the initial selection of a unit in the checklist for the command.
+    """
+    flags = self.systemd.units.get(unit)
+    if command == 'enable':
+      return bool(flags & (UNIT_ENABLED | UNIT_STATIC))
+    elif command == 'start':
+      return bool(flags & UNIT_STARTED)
+    elif command == 'state':
+      return (
+        bool(flags & (UNIT_ENABLED | UNIT_STATIC)),
+        bool(flags & UNIT_STARTED)
+      )
+    else:
+      return False
+
+  def toggle(self, unit, selected):
+    """
+    Return the next selection of a unit. The states of the state view cycle
+    through enabled and running, enabled, running and neither. Static units
+    are always enabled.
+    """
+    if not isinstance(selected, tuple):
+      return not selected
+    if self.systemd.is_static(unit):
+      return (True, not selected[1])
+    cycle = ((True, True), (True, False), (False, True), (False, False))
+    return cycle[(cycle.index(selected) + 1) % len(cycle)]
+
+  @ignore_curses_errors
+  def draw_header(self):
+    header = ' ' * PREFIX_LEN + HDR_SERVICES
+    if self.filter is not None:
+      header += ' [{}]'.format(self.filter.expression)
+    if self.systemd.stale:
+      header += ' ' + HDR_STALE
+    elif self.systemd.loading:
+      header += ' ' + HDR_LOADING
+    self.stdscr.move(0, self.vsplit+1)
+    self.stdscr.clrtoeol()
+    self.stdscr.addstr(0, self.vsplit+1, header[:max(0, self.w-self.vsplit-1)])
 
   @ignore_curses_errors
   def draw(self):
-    self.stdscr.clear()
+    # Only the cells that differ from the terminal are written, unless a
+    # repaint was requested with redraw().
+    self.stdscr.erase()
     self.stdscr.addstr(0, 0, HDR_COMMANDS)
-    self.stdscr.addstr(0, self.vsplit+1, ' ' * PREFIX_LEN + HDR_SERVICES)
+    self.draw_header()
     self.stdscr.bkgdset(' ', curses.color_pair(CP_DEFAULT))
     self.stdscr.vline(0, self.vsplit, curses.ACS_SBSB, self.h-2)
     self.stdscr.hline(1, 0, curses.ACS_BSBS, self.w)
@@ -663,15 +1579,46 @@ class Window(object):
     self.menu.draw()
     self.checklist.draw()
     self.update_status()
+    self.status.draw(nout=True)
     curses.doupdate()
 
+  def redraw(self):
+    """
+    Repaint the whole screen, e.g. after other output garbled it.
+    """
+    self.stdscr.clearok(True)
+    self.draw()
+
+  def resize(self):
+    """
+    Lay out the window for the new terminal size. Resize events that follow
+    within RESIZE_DELAY milliseconds of each other, e.g. while a terminal
+    multiplexer pane is dragged, are handled at once. The first other key is
+    put back.
+    """
+    self.stdscr.timeout(RESIZE_DELAY)
+    try:
+      c = self.stdscr.getch()
+      while c == curses.KEY_RESIZE:
+        c = self.stdscr.getch()
+    finally:
+      self.stdscr.timeout(POLL_TIMEOUT)
+    if c != curses.ERR:
+      curses.ungetch(c)
+    self.configure()
+    self.draw()
+
   def update_status(self, nout=True, line=None, cp=None, help=True):
     if line is None:
       command = self.menu.items[self.menu.current]
-      try:
-        line = MENU_COMMANDS[command]
-      except KeyError:
-        line = command
+      self.progress = self.job_progress()
+      if self.progress is not None:
+        line = self.progress
+      else:
+        try:
+          line = MENU_COMMANDS[command]
+        except KeyError:
+          line = command
     else:
       command = None
     self.status.configure(line, cp=cp, help=help)
@@ -680,42 +1627,216 @@ class Window(object):
     return command
 
   def run(self):
-    self.systemd.update()
+    # Start from the last known state, if any, and query the current one in the
+    # background.
+    loader = None
+    if self.systemd.load_snapshot():
+      self.updaters.append(Revalidator(self.systemd))
+    else:
+      # Show the loaded units while the unit files are listed.
+      loader = Loader(self.systemd)
+      loader.start()
+      if not loader.wait():
+        sys.stderr.write('error: failed to load systemd data\n')
+        sys.exit(1)
+    if self.systemd.stale or self.systemd.loading:
+      self.draw_header()
+      self.stdscr.noutrefresh()
+    if self.profile is not None:
+      self.profile.mark('query')
     self.update()
-    while self.active is not None:
-      self.active = self.active.run()
+    if self.profile is not None:
+      self.profile.mark('first draw')
+    if self.refresh_interval:
+      self.updaters.append(Poller(self.systemd, self.refresh_interval))
+    if self.watch:
+      watcher = self.systemd.backend.watcher(self.systemd)
+      if watcher is not None:
+        self.updaters.append(watcher)
+    for updater in self.updaters:
+      updater.start()
+    if loader is not None:
+      self.updaters.append(loader)
+    self.stdscr.timeout(POLL_TIMEOUT)
+    try:
+      while self.active is not None:
+        self.active = self.active.run()
+    finally:
+      for updater in self.updaters:
+        updater.stop()
+
+  def poll(self):
+    """
+    Apply pending background updates, if any, and repaint the rows of the units
+    that changed.
+    """
+    sub_len = self.systemd.sub_len
+    stale = (self.systemd.stale, self.systemd.loading)
+    changed = set()
+    error = None
+    for updater in self.updaters:
+      changed |= updater.apply()
+      if updater.error is not None:
+        error, updater.error = updater.error, None
+    if stale != (self.systemd.stale, self.systemd.loading):
+      self.draw_header()
+      self.stdscr.noutrefresh()
+      if self.updater_error:
+        # The failed query was repeated successfully.
+        self.updater_error = False
+        self.update_status(nout=False)
+    if error is not None:
+      self.updater_error = True
+      self.update_status(
+        nout=False,
+        line=error,
+        cp=curses.color_pair(CP_OFF)
+      )
+    finished = self.jobs.finished()
+    for job in finished:
+      if job.output is None:
+        # Cancelled before it ran.
+        self.log.write(' '.join([job.command] + job.units) + '\n')
+        self.log.write(job.error + '\n')
+      else:
+        self.log.write(job.output + '\n')
+      # Reset the selection of the units of the job to their new state.
+      changed.update(job.units)
+    if finished:
+      job = finished[-1]
+      if job.error is None or self.jobs.busy():
+        self.update_status(nout=False)
+      else:
+        self.update_status(
+          nout=False,
+          line='{}: {} [press F2 for the log]'.format(job, job.error),
+          cp=curses.color_pair(CP_OFF)
+        )
+        self.progress = None
+    elif self.progress is not None and self.job_progress() != self.progress:
+      self.update_status(nout=False)
+    if not changed:
+      return
+    command = self.menu.items[self.menu.current]
+    checklist = self.checklist.checklist
+
+    if sub_len != self.systemd.sub_len \
+    or any(self.is_shown(unit) != (unit in checklist) for unit in changed):
+      # Rows were added or removed or the status columns changed width.
+      try:
+        current = self.checklist.items[self.checklist.current]
+      except IndexError:
+        current = None
+      new_checklist = self.checklist_dict(command)
+      # Keep the pending selection of unchanged units, including template
+      # instances added by the user.
+      for unit, selected in checklist.items():
+        if unit not in changed:
+          new_checklist[unit] = selected
+      if current not in new_checklist:
+        current = min(self.checklist.current, max(0, len(new_checklist) - 1))
+      self.checklist.configure(
+        new_checklist,
+        current=current,
+        position=self.checklist.position,
+        print_status=self.checklist.print_status
+      )
+      self.configure()
+      self.checklist.draw()
 
+    else:
+      # External changes override the pending selection of the affected units.
+      for unit in changed:
+        if unit in checklist:
+          checklist[unit] = self.is_checked(command, unit)
+          i = self.checklist.find_item(unit)
+          self.checklist.change_item(i, self.checklist.item_cp(i))
+      self.checklist.draw(fill=False)
+
+
+  def submit(self, command, units, args=()):
+    self.jobs.submit(Job(command, units, timeout=self.timeout, args=args))
+    self.update_status(nout=False)
+
+  def job_progress(self):
+    """
+    Return a description of the running and queued jobs, or None if there are
+    none.
+    """
+    job = self.jobs.current
+    queued = len(self.jobs.pending)
+    if job is None:
+      if not queued:
+        return None
+      return '{:d} queued [F8 cancels]'.format(queued)
+    if job.started is None:
+      elapsed = 0
+    else:
+      elapsed = time.monotonic() - job.started
+    details = ['{:.0f} s'.format(elapsed)]
+    if job.chunks > 1:
+      details.append('{:d}/{:d} chunks'.format(job.chunks_done, job.chunks))
+    if queued:
+      details.append('{:d} queued'.format(queued))
+    return 'running {} ({}) [F8 cancels]'.format(job, ', '.join(details))
 
   def print_status(self, item, window, y, x, return_max=False):
     if return_max:
       return 5 + self.systemd.sub_len
     else:
-      window.addstr(y, x, self.systemd.get_sub(item), curses.color_pair(CP_DEFAULT))
-      x += 2 + self.systemd.sub_len
+      for string, cp in self.status_segments(item):
+        window.addstr(y, x, string, curses.color_pair(cp))
+        x += len(string)
+
+  def status_segments(self, item):
+    """
+    Return the status columns of a unit as (string, color pair) segments.
+    """
+    segments = [(self.systemd.get_sub(item), CP_DEFAULT)]
+
+    flags = self.systemd.units.get(item)
+    if flags & UNIT_STARTED:
+      segments.append(STATUS_SYMBOLS['start'])
+    elif flags & UNIT_ERROR:
+      segments.append(STATUS_SYMBOLS['error'])
+    else:
+      segments.append((' ', CP_DEFAULT))
 
-      if self.systemd.is_started(item):
-        c, cp = STATUS_SYMBOLS['start']
-      elif self.systemd.is_error(item):
-        c, cp = STATUS_SYMBOLS['error']
-      else:
-        c = ' '
-        cp = CP_DEFAULT
-      window.addstr(y, x, c, curses.color_pair(cp))
-      x += 1
-
-      window.addstr(y, x, ' ', curses.color_pair(CP_DEFAULT))
-      x += 1
-
-      if self.systemd.is_enabled(item):
-        c, cp = STATUS_SYMBOLS['enable']
-      elif self.systemd.is_static(item):
-        c, cp = STATUS_SYMBOLS['static']
-      else:
-        c = ' '
-        cp = CP_DEFAULT
-      window.addstr(y, x, c, curses.color_pair(cp))
-      x += 1
+    segments.append((' ', CP_DEFAULT))
 
+    if flags & UNIT_ENABLED:
+      segments.append(STATUS_SYMBOLS['enable'])
+    elif flags & UNIT_STATIC:
+      segments.append(STATUS_SYMBOLS['static'])
+    else:
+      segments.append((' ', CP_DEFAULT))
+    return segments
+
+
+  def get_state_checkbox(self, unit, enable, start):
+    """
+    Return the strings and colors of the prefix in the state view.
+    """
+    if self.systemd.is_static(unit):
+      c, cp = STATUS_SYMBOLS['static']
+    elif enable:
+      c, cp = STATUS_SYMBOLS['enable']
+    else:
+      c, cp = ' ', CP_DEFAULT
+    if start:
+      c_start, cp_start = STATUS_SYMBOLS['start']
+    else:
+      c_start, cp_start = ' ', CP_DEFAULT
+    return [(c, cp), (c_start.ljust(self.prefix_len() - 1, ' '), cp_start)]
+
+  def prefix_len(self):
+    """
+    Return the width of the prefix of the checklist items. The state view needs
+    room for two symbols and a space.
+    """
+    if self.menu.items[self.menu.current] == 'state':
+      return max(PREFIX_LEN, 3)
+    return PREFIX_LEN
 
   def get_checkbox(self, is_static=False):
     command = self.menu.items[self.menu.current]
@@ -729,164 +1850,179 @@ class Window(object):
 
 
   def run_command(self):
+    """
+    Submit the jobs that apply the selection. The selection of their units is
+    reset to the new state when they finish.
+    """
     command = self.menu.items[self.menu.current]
-    changed = False
     selected = set(k for k,v in self.checklist.checklist.items() if v)
+    # Units hidden by the filter are left alone.
+    shown = self.checklist.checklist.keys()
 
     if command == 'enable':
-      enabled = self.systemd.enabled - self.systemd.static
-      selected -= self.systemd.static
+      enabled = self.systemd.select(UNIT_ENABLED) & shown
+      selected -= self.systemd.select(UNIT_STATIC)
       newly_enabled = selected - enabled
       newly_disabled = enabled - selected
 
       if newly_enabled:
-        self.log += self.systemd.run_command('enable', newly_enabled)
-        self.log += '\n'
-        changed = True
+        self.submit('enable', newly_enabled)
 
       if newly_disabled:
-        self.log += self.systemd.run_command('disable', newly_disabled)
-        self.log += '\n'
-        changed = True
-
-      if changed:
-        self.systemd.update()
-        self.checklist.update_items(
-          self.systemd.as_dict(self.systemd.enabled | self.systemd.static)
-        )
-        self.checklist.draw()
+        self.submit('disable', newly_disabled)
+
+
 
+    elif command == 'state':
+      plan = self.systemd.plan(self.checklist.checklist)
+      if plan:
+        lines = [
+          ' '.join([command] + list(args) + sorted(units))
+          for command, args, units in plan
+        ]
+        if self.confirm(lines, 'Press y to run these commands or return to go back.'):
+          for command, args, units in plan:
+            self.submit(command, units, args)
 
 
     elif command in ('start', 'restart'):
       if selected:
-
-        newly_started = selected - self.systemd.started
+        started = self.systemd.select(UNIT_STARTED)
+        newly_started = selected - started
         if newly_started:
-          self.log += self.systemd.run_command('start', newly_started)
-          self.log += '\n'
+          self.submit('start', newly_started)
 
         if command == 'restart':
-          restarted = selected & self.systemd.started
+          restarted = selected & started
           if restarted:
-            self.log += self.systemd.run_command('restart', restarted)
-            self.log += '\n'
+            self.submit('restart', restarted)
 
         else:
-          newly_stopped = self.systemd.started - selected
+          newly_stopped = (started & shown) - selected
           if newly_stopped:
-            self.log += self.systemd.run_command('stop', newly_stopped)
-            self.log += '\n'
-
-        self.systemd.update()
-        if command == 'restart':
-          toggled = None
-        else:
-          toggled = self.systemd.started
-        self.checklist.update_items(self.systemd.as_dict(toggled))
-        self.checklist.draw()
+            self.submit('stop', newly_stopped)
 
 
     else:
       if selected:
-        self.log += self.systemd.run_command(command, selected)
-        self.log += '\n'
-        self.systemd.update()
+        self.submit(command, selected)
         for k in self.checklist.checklist:
           self.checklist.checklist[k] = False
-          self.checklist.draw()
+        self.checklist.draw()
 
 
 
   # TODO
   # Move to separate class.
   def display_text(self, what):
-
-    padding_south = 2
+    """
+    Page through the help or the log.
+    """
     return_msg = 'Press return to go back to the main window.'
     return_msg_len = len(return_msg)
 
     if what == 'help':
-      text = HELP_TEXT
-      padding_south += len(STATUS_SYMBOLS)
+      lines = HELP_TEXT.split('\n')[:-1]
+      footer = list()
+      for stat in sorted(STATUS_SYMBOLS):
+        sym, cp = STATUS_SYMBOLS[stat]
+        footer.append(("    {} : {}'d".format(sym, stat), cp))
+      w = max(len(x) for x in lines)
 
-    elif what == 'log':
-      text = self.log
-      if not text:
-        text = 'There is currently no output to display here.'
+    elif what == 'log' and self.log:
+      lines = self.log
+      footer = [('', CP_DEFAULT)]
+      w = self.log.width
 
     else:
-      text = 'Invalid display [].'.format(what)
-
-    lines = text.split('\n')
-    w = max(max(len(x) for x in lines), return_msg_len)
-    h = len(lines)
+      if what == 'log':
+        lines = ['There is currently no output to display here.']
+      else:
+        lines = ['Invalid display {}.'.format(what)]
+      footer = [('', CP_DEFAULT)]
+      w = len(lines[0])
+
+    footer.append((return_msg, CP_ACTIVE))
+    self.page(lines, footer, w)
+
+  def confirm(self, lines, question):
+    """
+    Show the lines and return True if the user answers the question with y.
+    """
+    footer = [('', CP_DEFAULT), (question, CP_ACTIVE)]
+    w = max(len(x) for x in lines)
+    return self.page(lines, footer, w, keys=(ord('\n'), ord('y'), ord('n'))) == ord('y')
+
+  def page(self, lines, footer, w, keys=(ord('\n'),)):
+    """
+    Page through the lines, followed by the footer of (line, color pair)
+    tuples, until one of the keys is pressed and return it. Only the visible
+    lines are rendered.
+    """
+    w = max(w, max(len(x) for x, cp in footer))
+    h = len(lines) + len(footer)
     x = 0
     y = 0
-    scr_h, scr_w = self.stdscr.getmaxyx()
+    # The text replaces the whole screen, which is cheaper to clear than to
+    # overwrite.
     self.stdscr.clear()
-    self.textpad.clear()
     self.stdscr.refresh()
 
-    self.textpad.resize(h+1+padding_south, w+1)
-    for i in range(h):
-      self.textpad.addstr(i, 0, lines[i].ljust(w, ' '), curses.color_pair(CP_DEFAULT))
-
-    if what == 'help':
-      for stat in sorted(STATUS_SYMBOLS):
-        sym, cp = STATUS_SYMBOLS[stat]
-        self.textpad.addstr(
-          h-1, 0,
-          "    {} : {}'d\n".format(sym, stat).ljust(w, ' '),
-          curses.color_pair(cp)
-        )
-        h += 1
-    else:
-      h += 1
-
-    self.textpad.addstr(
-      h, 0,
-      return_msg,
-      curses.color_pair(CP_ACTIVE)
-    )
-
     while True:
       try:
         scr_h, scr_w = self.stdscr.getmaxyx()
-        self.textpad.refresh(y, x, 0, 0, max(1, scr_h-1), max(1, scr_w-1))
+        y = max(0, min(y, h-scr_h))
+        x = max(0, min(x, w-scr_w))
+        self.textpad.erase()
+        self.textpad.resize(scr_h+1, w+1)
+        for row, i in enumerate(range(y, min(h, y+scr_h))):
+          if i < len(lines):
+            line, cp = lines[i], CP_DEFAULT
+          else:
+            line, cp = footer[i-len(lines)]
+          self.textpad.addstr(row, 0, line.ljust(w, ' '), curses.color_pair(cp))
+        self.textpad.refresh(0, x, 0, 0, max(1, scr_h-1), max(1, scr_w-1))
         curses.doupdate()
+        if self.output is not None:
+          self.output.stop()
         c = self.stdscr.getch()
+        while c == curses.ERR:
+          # Nothing is polled while paging, so the screen is only rendered again
+          # after a key.
+          c = self.stdscr.getch()
+        if self.output is not None:
+          self.output.key_pressed(c)
 
 
         if c == curses.KEY_RESIZE:
           continue
 
-        elif c == ord('\n'):
+        elif c in keys:
             break
 
         elif c == curses.KEY_UP:
-          y = max(y-1, 0)
+          y -= 1
 
         elif c == curses.KEY_DOWN:
-          y = min(y+1, h-scr_h)
+          y += 1
 
         elif c == curses.KEY_LEFT:
-          x = max(x-1, 0)
+          x -= 1
 
         elif c == curses.KEY_RIGHT:
-          x = min(x+1, w-scr_w)
+          x += 1
 
         elif c == curses.KEY_PPAGE:
-          y = max(y-scr_h, 0)
+          y -= scr_h
 
         elif c == curses.KEY_NPAGE:
-          y = min(y+scr_h, h-scr_h)
+          y += scr_h
 
         elif c == curses.KEY_HOME:
           y = 0
 
         elif c == curses.KEY_END:
-          y = max(0, h-scr_h)
+          y = h
 
 
       except curses.error:
@@ -895,160 +2031,1997 @@ class Window(object):
     self.configure()
     self.update()
     self.draw()
+    return c
 
 
 
 
 ################################### Systemd ####################################
-class Systemd(object):
-  def __init__(self, bin, args):
-    self.bin = bin
-    self.args = args
-    self.services = set()
-    self.started = set()
-    self.enabled = set()
-    self.static = set()
-    self.error = set()
-    self.sub = dict()
-    self.sub_len = 0
-    self.err = None
 
-  def as_dict(self, st=None):
-    if st is None:
-      foo = dict((x, False) for x in self.services)
-    else:
-      foo = dict()
-      for s in self.services:
-        foo[s] = (s in st)
-    return foo
-
-  def query_enabled(self):
-    cmd = [
-      self.bin,
-      '--no-legend',
-      'list-unit-files'
-    ] + self.args
+SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER = 'org.freedesktop.systemd1.Manager'
+SYSTEMD_UNIT = 'org.freedesktop.systemd1.Unit'
+UNIT_PROPERTIES = ('LoadState', 'ActiveState', 'SubState', 'UnitFileState')
+
+JOURNALCTL_CMD = ['journalctl', '--follow', '--lines=0', '--output=json']
+# Seconds to wait for events before checking if a watcher should stop.
+WATCH_TIMEOUT = 0.5
+# Seconds to wait for more journal messages before re-reading the units.
+WATCH_BATCH_DELAY = 0.1
+# Pending updates after which they are replaced by a full update.
+MAX_PENDING_UPDATES = 1000
+# Seconds after which a failed query of the initial state is repeated.
+QUERY_RETRY_DELAY = 5
+# Seconds between checks for the timeout or cancellation of a running job.
+JOB_POLL_INTERVAL = 0.1
+# Units of a job that are named in the status line.
+JOB_MAX_NAMES = 3
+# The properties that show that a unit command succeeded.
+UNIT_TARGET_STATES = {
+  'start' : ('ActiveState', ('active', 'reloading')),
+  'restart' : ('ActiveState', ('active', 'reloading')),
+  'stop' : ('ActiveState', ('inactive',)),
+  'enable' : ('UnitFileState', ('enabled', 'enabled-runtime')),
+  'disable' : ('UnitFileState', ('disabled',)),
+}
+# Format of the snapshots of the unit state and the flags saved in them.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FLAGS = UNIT_ENABLED | UNIT_STATIC | UNIT_STARTED | UNIT_ERROR
+MACHINE_ID_PATHS = ('/etc/machine-id', '/var/lib/dbus/machine-id')
 
+def read_machine_id():
+  """
+  Return the machine ID, or None if it cannot be read.
+  """
+  for path in MACHINE_ID_PATHS:
     try:
-      output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError:
-      sys.stderr.write('error: failed to load systemd data\n')
-      sys.exit(1)
-
-    self.services.clear()
-    self.enabled.clear()
-    self.static.clear()
-    for service in output.decode().strip().split('\n'):
-      service = service.strip()
-      if not service:
+      with open(path) as f:
+        machine_id = f.read().strip()
+    except OSError:
+      continue
+    if machine_id:
+      return machine_id
+  return None
+
+def snapshot_path(scope):
+  """
+  Return the path of the snapshot of the unit state for the scope, a list of
+  the systemctl binary and its arguments, e.g. separate ones for the system
+  and the --user manager.
+  """
+  import zlib
+  cache = os.environ.get('XDG_CACHE_HOME', '')
+  if not os.path.isabs(cache):
+    cache = os.path.join(os.path.expanduser('~'), '.cache')
+  key = zlib.crc32(json.dumps(scope).encode('utf-8'))
+  return os.path.join(cache, 'serman', 'units-{:08x}.json'.format(key))
+
+def unit_name_from_path(path):
+  """
+  Return the unit name from a unit object path, in which characters other than
+  letters and digits are escaped as "_" followed by two hex digits.
+  """
+  label = path.rsplit('/', 1)[-1]
+  name = ''
+  i = 0
+  while i < len(label):
+    if label[i] == '_':
+      try:
+        name += chr(int(label[i+1:i+3], 16))
+        i += 3
         continue
-      name, status = service.split(None, 1)
-      self.services.add(name)
-      if status == 'enabled':
-        self.enabled.add(name)
-      elif status == 'static':
-        self.static.add(name)
+      except ValueError:
+        pass
+    name += label[i]
+    i += 1
+  return name
 
+def unit_file_sets(unit_files):
+  """
+  Sort (name, state) pairs of unit files into the sets of unit files, enabled
+  unit files and static unit files.
+  """
+  services = set()
+  enabled = set()
+  static = set()
+  for name, status in unit_files:
+    services.add(name)
+    if status == 'enabled':
+      enabled.add(name)
+    elif status == 'static':
+      static.add(name)
+  return services, enabled, static
+
+def unit_sets(units):
+  """
+  Sort (name, load state, active state, sub state) tuples of loaded units into
+  the sets of started units, failed units and a dict of sub states.
+  """
+  started = set()
+  error = set()
+  sub = dict()
+  for name, loaded, active, substate in units:
+    sub[name] = substate
+    if loaded == 'loaded' and active == 'active':
+      started.add(name)
+    elif loaded == 'error' or active == 'failed':
+      error.add(name)
+  return started, error, sub
 
-  def query_started(self):
-    cmd = [
-      self.bin,
-      '--no-legend',
-      '--all',
-      '--full'
-    ] + self.args
 
-    try:
-      output = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError:
-      sys.stderr.write('error: failed to load systemd data\n')
-      sys.exit(1)
 
-    self.started.clear()
-    self.sub.clear()
-    self.sub_len = 0
-    for line in output.decode().strip().split('\n'):
-      name, loaded, active, sub, rest = line.split(None, 4)
-      if not name in self.services:
-        bname = '{}@.service'.format(name.split('@',1)[0])
-        if bname in self.services:
-          self.services.add(name)
-          self.enabled.add(name)
-        else:
-          continue
-      self.sub[name] = sub
-      self.sub_len = max(self.sub_len, len(sub))
-      if loaded == 'loaded' and active == 'active':
-        self.started.add(name)
-      elif loaded == 'error' or active == 'failed':
-        self.error.add(name)
+class Backend(object):
+  """
+  Interface between Systemd and the systemd manager.
+
+  query() returns the unit files and loaded units as a tuple of the results of
+  unit_file_sets() and unit_sets(), or None on failure. If on_units is given,
+  it may be called with the result of unit_sets() as soon as that is known,
+  before the unit files are listed. show() returns a dict
+  with the LoadState, ActiveState, SubState and UnitFileState properties of
+  each of the given units, in the same order, or None on failure. run_command()
+  runs the unit command of a Job, honouring its timeout and cancellation, and
+  returns a message for the log.
+
+  Backends may be used from several threads at once. If concurrent is True,
+  commands gain from running in parallel.
+  """
 
-  def update(self):
-    self.query_enabled()
-    self.query_started()
+  concurrent = False
 
-  def is_enabled(self, unit):
-    try:
-      return (unit in self.enabled)
-    except KeyError:
+  def query(self, on_units=None):
+    raise NotImplementedError
+
+  def show(self, units):
+    raise NotImplementedError
+
+  def run_command(self, job):
+    raise NotImplementedError
+
+  def watcher(self, systemd):
+    """
+    Return an Updater that follows changes as the manager reports them, or
+    None if that is not supported.
+    """
+    return None
+
+  def close(self):
+    pass
+
+
+
+class SystemctlBackend(Backend):
+  """
+  Query and control systemd by running systemctl.
+  """
+
+  concurrent = True
+
+  def __init__(self, bin, args, use_json=True):
+    self.bin = bin
+    self.args = args
+    self.use_json = use_json
+
+  def systemctl(self, *args, stderr=None):
+    """
+    Start a systemctl query and return the process without waiting for it.
+    """
+    # The global options go first as show ends the arguments with "--".
+    cmd = [
+      self.bin,
+      '--no-legend',
+    ] + self.args + list(args)
+    return subprocess.Popen(
+      cmd,
+      stdout=subprocess.PIPE,
+      stderr=stderr,
+      universal_newlines=True
+    )
+
+  def collect(self, p, parse):
+    """
+    Parse the output of a query started with systemctl() line by line as it is
+    written. None is returned if the query failed.
+    """
+    with p.stdout:
+      result = parse(p.stdout)
+    if p.wait() != 0:
+      return None
+    return result
+
+  def split_unit_files(self, lines):
+    for line in lines:
+      # Newer versions append a vendor preset column.
+      fields = line.split(None, 2)
+      if len(fields) < 2:
+        continue
+      yield fields[0], fields[1]
+
+  def split_units(self, lines):
+    for line in lines:
+      fields = line.split(None, 5)
+      # Newer versions mark failed and missing units with a leading bullet.
+      if fields and fields[0] in UNIT_BULLETS:
+        del fields[0]
+      if len(fields) < 4:
+        continue
+      yield tuple(fields[:4])
+
+  def parse_enabled(self, lines):
+    return unit_file_sets(self.split_unit_files(lines))
+
+  def parse_started(self, lines):
+    return unit_sets(self.split_units(lines))
+
+  def parse_enabled_json(self, lines):
+    try:
+      units = json.load(lines)
+    except ValueError:
+      return None
+    return unit_file_sets(
+      (unit['unit_file'].rsplit('/', 1)[-1], unit['state'])
+      for unit in units
+    )
+
+  def parse_started_json(self, lines):
+    try:
+      units = json.load(lines)
+    except ValueError:
+      return None
+    return unit_sets(
+      (unit['unit'], unit['load'], unit['active'], unit['sub'])
+      for unit in units
+    )
+
+  def query_units(self, use_json=False, on_units=None):
+    """
+    Return the parsed output of list-unit-files and list-units, or None if
+    either query failed, and the exit statuses of both.
+    """
+    if use_json:
+      # Older versions reject the option so their complaints are hidden.
+      opts = ('--output=json',)
+      stderr = subprocess.DEVNULL
+      parse_enabled = self.parse_enabled_json
+      parse_started = self.parse_started_json
+    else:
+      opts = ()
+      stderr = None
+      parse_enabled = self.parse_enabled
+      parse_started = self.parse_started
+
+    # Both queries are started before either is read so that a refresh takes as
+    # long as the slower of the two instead of their sum.
+    enabled_p = self.systemctl('list-unit-files', *opts, stderr=stderr)
+    started_p = self.systemctl('--all', '--full', 'list-units', *opts, stderr=stderr)
+    # A plain thread reads one of them: an executor would cost more to import
+    # than the whole query takes on small systems.
+    result = dict()
+    thread = threading.Thread(
+      target=lambda: result.update(enabled=self.collect(enabled_p, parse_enabled))
+    )
+    thread.start()
+    started = self.collect(started_p, parse_started)
+    # list-units is usually done first as list-unit-files reads every unit file.
+    if started is not None and on_units is not None:
+      on_units(started)
+    thread.join()
+    enabled = result.get('enabled')
+    returncodes = (enabled_p.returncode, started_p.returncode)
+    if enabled is None or started is None:
+      return None, returncodes
+    return (enabled, started), returncodes
+
+  def json_rejected(self, returncodes):
+    """
+    Return True if the exit statuses of a failed JSON query show that systemctl
+    does not support JSON output, as opposed to a failure of the query itself.
+    """
+    if all(code == 0 for code in returncodes):
+      # Versions that accept the option for the journal print text instead.
+      return True
+    if any(code < 0 for code in returncodes):
+      # Killed, e.g. when the session ended.
       return False
+    # Versions that do not know the option reject it before --version is
+    # handled.
+    try:
+      p = subprocess.run(
+        [self.bin, '--output=json', '--version'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+      )
+    except OSError:
+      return False
+    return p.returncode != 0
+
+  def query(self, on_units=None):
+    callbacks = [on_units] if on_units is not None else []
+    def on_first_units(started):
+      # Called once even if the text output is read after the JSON output.
+      while callbacks:
+        callbacks.pop()(started)
+
+    if self.use_json:
+      result, returncodes = self.query_units(use_json=True, on_units=on_first_units)
+      if result is not None:
+        return result
+      if self.json_rejected(returncodes):
+        # Fall back to the text output for good.
+        self.use_json = False
+    result, returncodes = self.query_units(on_units=on_first_units)
+    return result
+
+  def parse_show(self, lines):
+    # systemctl show prints one block of properties per unit, in the order in
+    # which the units were given, separated by empty lines.
+    states = list()
+    props = None
+    for line in lines:
+      line = line.rstrip('\n')
+      if not line:
+        props = None
+        continue
+      if props is None:
+        props = dict()
+        states.append(props)
+      key, sep, value = line.partition('=')
+      if sep:
+        props[key] = value
+    return states
+
+  def show(self, units):
+    p = self.systemctl(
+      'show',
+      '-p', ','.join(UNIT_PROPERTIES),
+      '--',
+      *units
+    )
+    return self.collect(p, self.parse_show)
 
-  def is_static(self, unit):
+  def watcher(self, systemd):
+    return JournalWatcher(systemd, self.args)
+
+  def run_command(self, job):
+    cmd = [
+      self.bin,
+    ] + self.args + [job.command,] + job.args + job.units
+    import shlex
+    command = ' '.join(shlex.quote(x) for x in cmd)
+    if DEBUG_LOG:
+      debug(command)
+      return command
+    p = subprocess.Popen(
+      cmd,
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      universal_newlines=True
+    )
+    while True:
+      try:
+        output, err = p.communicate(timeout=JOB_POLL_INTERVAL)
+        break
+      except subprocess.TimeoutExpired:
+        if job.check():
+          p.kill()
+          output, err = p.communicate()
+          break
+    msg = command
+    if output:
+      msg += '\n' + output
+    if err:
+      msg += '\n' + err
+    if job.state == 'running' and p.returncode:
+      job.fail('failed', 'exit status {:d}'.format(p.returncode))
+    elif job.state != 'running':
+      msg += '\n' + job.error
+      # Killing systemctl only stops the wait, the manager keeps the jobs.
+      cancelled = self.cancel_jobs(job.units)
+      if cancelled is None:
+        msg += '\nStopped waiting, the jobs could not be cancelled.'
+      elif cancelled:
+        msg += '\nCancelled jobs ' + ' '.join(cancelled)
+    return msg
+
+  def split_jobs(self, lines):
+    for line in lines:
+      fields = line.split(None, 2)
+      if len(fields) == 3:
+        yield fields[0], fields[1]
+
+  def cancel_jobs(self, units):
+    """
+    Cancel the pending manager jobs of the units and return their ids, or None
+    if they could not be listed or cancelled.
+    """
+    units = set(units)
+    jobs = self.collect(
+      self.systemctl('list-jobs', stderr=subprocess.DEVNULL),
+      lambda lines: [j for j, unit in self.split_jobs(lines) if unit in units]
+    )
+    if not jobs:
+      return jobs
+    p = self.systemctl('cancel', *jobs, stderr=subprocess.DEVNULL)
+    if self.collect(p, lambda lines: True) is None:
+      return None
+    return jobs
+
+
+
+class DBusBackend(Backend):
+  """
+  Query and control the systemd manager over a single persistent D-Bus
+  connection. Commands without a manager method (e.g. status) are passed on to
+  the fallback backend.
+  """
+
+  # Commands that queue a job for each unit.
+  JOB_METHODS = {
+    'start' : 'StartUnit',
+    'stop' : 'StopUnit',
+    'restart' : 'RestartUnit',
+    'reload' : 'ReloadUnit',
+    'try-restart' : 'TryRestartUnit',
+    'reload-or-restart' : 'ReloadOrRestartUnit',
+  }
+
+  def __init__(self, bus, fallback):
+    self.bus = bus
+    self.fallback = fallback
+    # The connection is not thread-safe.
+    self.lock = threading.RLock()
+    self.conn = jeepney.io.blocking.open_dbus_connection(bus=bus)
+    self.manager = jeepney.DBusAddress(
+      SYSTEMD_PATH,
+      bus_name=SYSTEMD_BUS_NAME,
+      interface=SYSTEMD_MANAGER
+    )
+    # The manager only emits signals while at least one client is subscribed.
+    self.call('Subscribe')
+
+  def call(self, method, signature=None, body=()):
+    msg = jeepney.new_method_call(self.manager, method, signature, body)
+    with self.lock:
+      return jeepney.wrappers.unwrap_msg(self.conn.send_and_get_reply(msg))
+
+  def close(self):
+    self.conn.close()
+
+  def watcher(self, systemd):
+    return DBusWatcher(systemd, self.bus)
+
+  def signal_rule(self, member, sender=None):
+    """
+    Match a manager signal. Received signals carry the unique name of the
+    sender so the well-known name can only be matched by the bus, not by local
+    filters.
+    """
+    return jeepney.MatchRule(
+      type='signal',
+      sender=sender,
+      interface=SYSTEMD_MANAGER,
+      member=member,
+      path=SYSTEMD_PATH
+    )
+
+  def query(self, on_units=None):
     try:
-      return (unit in self.static)
+      units = self.call('ListUnits')[0]
+      # ListUnits returns (name, description, load state, active state, sub
+      # state, ...) tuples.
+      started = unit_sets((unit[0], unit[2], unit[3], unit[4]) for unit in units)
+      if on_units is not None:
+        on_units(started)
+      unit_files = self.call('ListUnitFiles')[0]
+    except (jeepney.DBusErrorResponse, OSError):
+      return None
+    return (
+      unit_file_sets(
+        (path.rsplit('/', 1)[-1], status) for path, status in unit_files
+      ),
+      started,
+    )
+
+  def show(self, units):
+    try:
+      listed = self.call('ListUnitsByNames', 'as', (list(units),))[0]
+    except (jeepney.DBusErrorResponse, OSError):
+      return None
+    states = list()
+    for unit in listed:
+      name, description, loaded, active, substate = unit[:5]
+      try:
+        status = self.call('GetUnitFileState', 's', (name,))[0]
+      except jeepney.DBusErrorResponse:
+        status = ''
+      states.append({
+        'LoadState' : loaded,
+        'ActiveState' : active,
+        'SubState' : substate,
+        'UnitFileState' : status,
+      })
+    return states
+
+  def run_command(self, job):
+    if job.command in self.JOB_METHODS:
+      with self.lock:
+        return self.run_jobs(job)
+    elif job.command in ('enable', 'disable'):
+      msg = self.change_unit_files(job)
+      if '--now' in job.args and job.state == 'running':
+        with self.lock:
+          msg += '\n' + self.run_jobs(job, 'start' if job.command == 'enable' else 'stop')
+      return msg
+    else:
+      return self.fallback.run_command(job)
+
+  def run_jobs(self, job, command=None):
+    """
+    Queue a manager job for each unit and wait for all of them to finish, as
+    systemctl does. The command defaults to that of the Job. If the Job times
+    out or is cancelled, the manager jobs that are still pending are cancelled.
+    """
+    if command is None:
+      command = job.command
+    units = job.units
+    method = self.JOB_METHODS[command]
+    msg = [' '.join([method] + units)]
+    rule = self.signal_rule('JobRemoved')
+    bus_rule = self.signal_rule('JobRemoved', sender=SYSTEMD_BUS_NAME)
+    self.conn.send_and_get_reply(jeepney.message_bus.AddMatch(bus_rule))
+    try:
+      # The filter must be in place before the jobs are queued to catch jobs
+      # that finish immediately.
+      with self.conn.filter(rule, queue=collections.deque()) as queue:
+        jobs = dict()
+        for unit in units:
+          try:
+            path = self.call(method, 'ss', (unit, 'replace'))[0]
+            jobs[path] = unit
+          except jeepney.DBusErrorResponse as e:
+            job.results[unit] = dbus_error(e)
+            msg.append('Failed to {} {}: {}'.format(command, unit, dbus_error(e)))
+        while jobs:
+          try:
+            signal = self.conn.recv_until_filtered(queue, timeout=JOB_POLL_INTERVAL)
+          except TimeoutError:
+            if job.check():
+              msg.append('{} {}'.format(job.error, ' '.join(sorted(jobs.values()))))
+              for unit in jobs.values():
+                job.results[unit] = job.error
+              self.cancel_jobs(jobs)
+              break
+            continue
+          job_id, path, unit, result = signal.body
+          if jobs.pop(path, None) is not None and result != 'done':
+            job.results[unit] = 'result "{}"'.format(result)
+            msg.append('Job for {} failed with result "{}".'.format(unit, result))
+    finally:
+      self.conn.send_and_get_reply(jeepney.message_bus.RemoveMatch(bus_rule))
+    if job.state == 'running' and len(msg) > 1:
+      job.fail('failed', '{:d} of {:d} units failed'.format(len(msg) - 1, len(units)))
+    return '\n'.join(msg)
+
+  def cancel_jobs(self, jobs):
+    for path in jobs:
+      try:
+        self.call('CancelJob', 'u', (int(path.rsplit('/', 1)[-1]),))
+      except (jeepney.DBusErrorResponse, ValueError):
+        pass
+
+  def change_unit_files(self, job):
+    command, units = job.command, job.units
+    try:
+      if command == 'enable':
+        changes = self.call('EnableUnitFiles', 'asbb', (units, False, False))[1]
+      else:
+        changes = self.call('DisableUnitFiles', 'asb', (units, False))[0]
+      # systemctl reloads the manager after changing unit files.
+      self.call('Reload')
+    except jeepney.DBusErrorResponse as e:
+      job.fail('failed', dbus_error(e))
+      return job.error
+    msg = [' '.join([command] + units)]
+    for change, filename, destination in changes:
+      if change == 'symlink':
+        msg.append('Created symlink {} → {}.'.format(filename, destination))
+      elif change == 'unlink':
+        msg.append('Removed {}.'.format(filename))
+    return '\n'.join(msg)
+
+def dbus_error(e):
+  try:
+    return e.data[0]
+  except (IndexError, TypeError):
+    return e.name
+
+
+
+class UnitTable(object):
+  """
+  The state of units in columns: a list of the interned names, a dict mapping
+  them to their rows and arrays of the UNIT_* flags, the unit type codes and
+  the sub state codes of each row. The codes index type_names and sub_names.
+
+  Rows are never removed: a new table is built for each full state instead.
+  sorted stays True while the rows are added in the order of their names.
+  """
+
+  def __init__(self):
+    self.names = list()
+    self.rows = dict()
+    self.flags = array.array('B')
+    self.types = array.array('H')
+    self.subs = array.array('H')
+    self.type_names = list()
+    self.type_codes = dict()
+    # Code 0 is for units without a sub state.
+    self.sub_names = [None]
+    self.sub_codes = {None : 0}
+    self.sorted = True
+
+  @classmethod
+  def build(cls, names, flags, subs):
+    """
+    Return a table of the sorted names with the flags and sub states in the
+    same order. This is much faster than adding them one by one.
+    """
+    table = cls()
+    table.names = names = list(map(sys.intern, names))
+    table.rows = dict(zip(names, itertools.count()))
+    parts = [name.rpartition('.') for name in names]
+    table.flags = array.array('B', [
+      f | UNIT_INSTANCE if '@' in base and not base.endswith('@') else f
+      for f, (base, _, _) in zip(flags, parts)
+    ])
+    code = table.code
+    type_codes, type_names = table.type_codes, table.type_names
+    table.types = array.array('H', [
+      code(type_codes, type_names, unit_type) for _, _, unit_type in parts
+    ])
+    sub_codes, sub_names = table.sub_codes, table.sub_names
+    table.subs = array.array('H', [code(sub_codes, sub_names, sub) for sub in subs])
+    return table
+
+  def __len__(self):
+    return len(self.names)
+
+  def __contains__(self, name):
+    return name in self.rows
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def code(self, codes, names, value):
+    try:
+      return codes[value]
     except KeyError:
+      code = codes[value] = len(names)
+      names.append(value if value is None else sys.intern(value))
+      return code
+
+  def add(self, name, flags=0, sub=None):
+    """
+    Add a unit, or set the flags and sub state of a known one, and return its
+    row.
+    """
+    row = self.rows.get(name)
+    base, _, unit_type = name.rpartition('.')
+    if '@' in base and not base.endswith('@'):
+      flags |= UNIT_INSTANCE
+    if row is None:
+      name = sys.intern(name)
+      if self.names and name < self.names[-1]:
+        self.sorted = False
+      row = self.rows[name] = len(self.names)
+      self.names.append(name)
+      self.flags.append(flags)
+      self.types.append(self.code(self.type_codes, self.type_names, unit_type))
+      self.subs.append(self.code(self.sub_codes, self.sub_names, sub))
+    else:
+      self.flags[row] = flags
+      self.subs[row] = self.code(self.sub_codes, self.sub_names, sub)
+    return row
+
+  def get(self, name):
+    """
+    Return the flags of the unit, or 0 if it is not in the table.
+    """
+    row = self.rows.get(name)
+    if row is None:
+      return 0
+    return self.flags[row]
+
+  def sub(self, name):
+    row = self.rows.get(name)
+    if row is None:
+      return None
+    return self.sub_names[self.subs[row]]
+
+  def select(self, mask):
+    """
+    Return an iterator over the units with any of the flags in the mask.
+    """
+    return itertools.compress(self.names, map(mask.__and__, self.flags))
+
+  def select_types(self, unit_types):
+    """
+    Return an iterator over the units of the given types.
+    """
+    codes = set(self.type_codes[t] for t in unit_types if t in self.type_codes)
+    return itertools.compress(self.names, map(codes.__contains__, self.types))
+
+  def sub_len(self):
+    return max((len(x) for x in self.sub_names[1:]), default=0)
+
+
+
+class Systemd(object):
+  def __init__(self, backend, scope=None):
+    self.backend = backend
+    # The scope of the snapshot of the state, if it is kept, and its path.
+    self.scope = scope
+    if scope is None:
+      self.snapshot = None
+    else:
+      self.snapshot = snapshot_path(scope)
+    # True while the state is loaded from the snapshot and not yet queried.
+    self.stale = False
+    # True while only the loaded units are known, see query().
+    self.loading = False
+    # The services and their state. Sets of them are returned by select().
+    self.units = UnitTable()
+    self.sub_len = 0
+    # Incremented whenever the state changes.
+    self.generation = 0
+    # The generation at which each unit was last patched, see keep_patched().
+    self.patched = dict()
+    self.sorted_cache = None
+    # Values derived from the state by cached(), valid for one generation.
+    self.cache = dict()
+    self.cache_generation = 0
+    # Serializes changes to the state by the UI and reads of it by the
+    # updaters. The backend serializes its own use.
+    self.lock = threading.RLock()
+
+  @property
+  def services(self):
+    return self.units.rows.keys()
+
+  def as_dict(self, st=None, units=None):
+    if units is None:
+      units = self.services
+    if st is None:
+      foo = dict((x, False) for x in units)
+    else:
+      foo = dict()
+      for s in units:
+        foo[s] = (s in st)
+    return foo
+
+  def cached(self, key, build):
+    """
+    Return the value cached for the key, calling build() to create it if there
+    is none for the current generation of the state.
+    """
+    if self.cache_generation != self.generation:
+      self.cache.clear()
+      self.cache_generation = self.generation
+    try:
+      return self.cache[key]
+    except KeyError:
+      value = self.cache[key] = build()
+      return value
+
+  def select(self, mask):
+    """
+    Return the set of services with any of the UNIT_* flags in the mask, e.g.
+    UNIT_ENABLED | UNIT_STATIC. It is cached for the current generation and must
+    not be modified.
+    """
+    return self.cached(('select', mask), lambda: frozenset(self.units.select(mask)))
+
+  def select_types(self, unit_types):
+    """
+    Return the set of services of the given unit types, cached like select().
+    """
+    unit_types = tuple(sorted(unit_types))
+    return self.cached(
+      ('types', unit_types),
+      lambda: frozenset(self.units.select_types(unit_types))
+    )
+
+  def sorted_services(self):
+    """
+    Return the sorted services and a dict mapping them to their positions. Both
+    are cached until the set of services changes and must not be modified.
+    """
+    if self.sorted_cache is None:
+      if self.units.sorted:
+        # Shared with the table, which patch() copies before adding rows.
+        self.sorted_cache = (self.units.names, self.units.rows)
+      else:
+        items = sorted(self.units.names)
+        self.sorted_cache = (items, dict((x, i) for i, x in enumerate(items)))
+    return self.sorted_cache
+
+  def merge(self, enabled_data, started_data):
+    """
+    Combine the results of unit_file_sets() and unit_sets() into a UnitTable
+    that can be passed to apply(). Units that are not in the unit files are kept
+    only if they are instances of a template, which count as enabled.
+    """
+    services, enabled, static = enabled_data
+    started, error, sub = started_data
+    names = set(services)
+    for name in sub:
+      if not name in services:
+        bname = '{}@.service'.format(name.split('@',1)[0])
+        if bname in services:
+          names.add(name)
+    names = sorted(names)
+    return UnitTable.build(
+      names,
+      [
+        (
+          UNIT_ENABLED if name in enabled or name not in services
+          else UNIT_STATIC if name in static
+          else 0
+        ) | (
+          UNIT_STARTED if name in started
+          else UNIT_ERROR if name in error
+          else 0
+        )
+        for name in names
+      ],
+      map(sub.get, names)
+    )
+
+  def apply(self, state, loading=False):
+    """
+    Replace the state with a UnitTable, e.g. one returned by query().
+    """
+    with self.lock:
+      self.units = state
+      self.sub_len = state.sub_len()
+      self.sorted_cache = None
+      self.stale = False
+      self.loading = loading
+      self.generation += 1
+
+  def load_snapshot(self):
+    """
+    Apply the state saved by save_snapshot() and mark it as stale. Return False
+    if there is no valid snapshot for this machine. Invalid snapshots are
+    removed.
+    """
+    if self.snapshot is None:
+      return False
+    try:
+      with open(self.snapshot) as f:
+        data = json.load(f)
+    except (OSError, ValueError):
+      data = None
+    state = None
+    machine_id = read_machine_id()
+    try:
+      if data['version'] == SNAPSHOT_VERSION \
+      and data['scope'] == self.scope \
+      and machine_id is not None \
+      and data['machine_id'] == machine_id:
+        names, flags, subs = list(zip(*data['units'])) or ((), (), ())
+        if not (
+          all(isinstance(x, str) for x in names)
+          and all(isinstance(x, int) for x in flags)
+          and all(x is None or isinstance(x, str) for x in subs)
+        ):
+          raise ValueError('invalid unit')
+        if any(a >= b for a, b in zip(names, names[1:])):
+          raise ValueError('unsorted units')
+        state = UnitTable.build(names, map(SNAPSHOT_FLAGS.__and__, flags), subs)
+    except (KeyError, TypeError, ValueError):
+      state = None
+    if state is None:
+      if data is not None:
+        try:
+          os.remove(self.snapshot)
+        except OSError:
+          pass
       return False
+    self.apply(state)
+    self.stale = True
+    return True
+
+  def save_snapshot(self):
+    """
+    Save the current state for load_snapshot() if it was queried from systemd.
+    Failures are ignored.
+    """
+    machine_id = read_machine_id()
+    if self.snapshot is None or machine_id is None or self.stale \
+    or self.loading or not self.generation:
+      return
+    with self.lock:
+      table = self.units
+      units = sorted(zip(
+        table.names,
+        map(SNAPSHOT_FLAGS.__and__, table.flags),
+        map(table.sub_names.__getitem__, table.subs)
+      ))
+    data = {
+      'version' : SNAPSHOT_VERSION,
+      'scope' : self.scope,
+      'machine_id' : machine_id,
+      'units' : units,
+    }
+    tmp = '{}.{:d}'.format(self.snapshot, os.getpid())
+    try:
+      os.makedirs(os.path.dirname(self.snapshot), exist_ok=True)
+      with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+      os.replace(tmp, self.snapshot)
+    except OSError:
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+
+  def diff(self, state):
+    """
+    Return the names of the units whose state differs from the given UnitTable.
+    """
+    with self.lock:
+      table = self.units
+      changed = set(table.rows.keys() ^ state.rows.keys())
+      for name, row in state.rows.items():
+        old = table.rows.get(name)
+        if old is not None and (
+          table.flags[old] != state.flags[row]
+          or table.sub_names[table.subs[old]] != state.sub_names[state.subs[row]]
+        ):
+          changed.add(name)
+    return changed
+
+  def query(self, on_units=None):
+    """
+    Query the backend and return the merged state, or None on failure. The
+    current state is not changed. If on_units is given, it may be called with a
+    state of only the loaded units before the unit files are known, to be
+    applied with loading=True.
+    """
+    if on_units is None:
+      result = self.backend.query()
+    else:
+      result = self.backend.query(
+        on_units=lambda started_data: on_units(self.units_state(started_data))
+      )
+    if result is None:
+      return None
+    return self.merge(*result)
+
+  def units_state(self, started_data):
+    """
+    Return a state with the units of a result of unit_sets() as the services
+    and no unit files.
+    """
+    started, error, sub = started_data
+    names = sorted(sub)
+    return UnitTable.build(
+      names,
+      [
+        UNIT_STARTED if name in started else UNIT_ERROR if name in error else 0
+        for name in names
+      ],
+      map(sub.get, names)
+    )
+
+  def update(self):
+    state = self.query()
+    if state is None:
+      sys.stderr.write('error: failed to load systemd data\n')
+      sys.exit(1)
+    self.apply(state)
+
+  def show(self, units):
+    """
+    Return a dict mapping each of the given units to a dict of its properties,
+    or None if the query failed.
+    """
+    units = sorted(units)
+    states = self.backend.show(units)
+    if states is None or len(states) != len(units):
+      return None
+    return dict(zip(units, states))
+
+  def update_units(self, props):
+    with self.lock:
+      self.patch(props)
+      self.generation += 1
+      for name in props:
+        self.patched[name] = self.generation
+
+  def keep_patched(self, state, since):
+    """
+    Copy the rows of the units that were patched after the given generation to
+    a UnitTable whose query started at that generation. Their patched state was
+    read later than the query, e.g. after a command changed them.
+    """
+    table = self.units
+    for name, generation in self.patched.items():
+      if generation > since and name in table:
+        state.add(name, table.get(name), table.sub(name))
+
+  def patch(self, props):
+    """
+    Patch the state of units with dicts of their LoadState, ActiveState,
+    SubState and UnitFileState properties. The state that depends on a missing
+    property is left as it is.
+    """
+    table = self.units
+    for name, unit_props in props.items():
+      loaded = unit_props.get('LoadState', 'loaded')
+      status = unit_props.get('UnitFileState', '')
+      bname = '{}@.service'.format(name.split('@',1)[0])
+      row = table.rows.get(name)
+      # As in merge(), instances without a unit file of their own count as
+      # enabled, whether or not they are already known.
+      is_instance = (name != bname and bname in table)
+
+      # As in merge(), only unit files and template instances are tracked.
+      if row is None:
+        if not (status or is_instance):
+          continue
+        if self.sorted_cache is not None:
+          # The sorted services may share the names and rows of the table.
+          table.names = list(table.names)
+          table.rows = dict(table.rows)
+          self.sorted_cache = None
+        row = table.add(name)
+      flags = table.flags[row]
+
+      if 'UnitFileState' in unit_props or is_instance:
+        flags &= ~(UNIT_ENABLED | UNIT_STATIC)
+        if status == 'enabled' or (is_instance and not status):
+          flags |= UNIT_ENABLED
+        elif status == 'static':
+          flags |= UNIT_STATIC
+
+      if 'ActiveState' in unit_props:
+        active = unit_props['ActiveState']
+        flags &= ~(UNIT_STARTED | UNIT_ERROR)
+        if loaded == 'loaded' and active == 'active':
+          flags |= UNIT_STARTED
+        elif loaded == 'error' or active == 'failed':
+          flags |= UNIT_ERROR
+      table.flags[row] = flags
+
+      if 'SubState' in unit_props and loaded != 'not-found':
+        substate = unit_props['SubState']
+        table.subs[row] = table.code(table.sub_codes, table.sub_names, substate)
+        self.sub_len = max(self.sub_len, len(substate))
+
+  def is_known(self, unit):
+    """
+    Return True if the unit is tracked or is an instance of a tracked template.
+    """
+    if unit in self.units:
+      return True
+    return '@' in unit \
+      and '{}@.service'.format(unit.split('@',1)[0]) in self.units
+
+  def plan(self, desired):
+    """
+    Return the commands that bring units to their desired state as (command,
+    args, units) tuples. desired maps units to (enable, start) tuples in which
+    None keeps the current state. The unit files of static units are left
+    alone. Enabling or disabling and starting or stopping a unit are combined
+    with --now where possible.
+    """
+    enabled = self.select(UNIT_ENABLED)
+    started = self.select(UNIT_STARTED)
+    plan = collections.OrderedDict((
+      (('enable', ('--now',)), set()),
+      (('disable', ('--now',)), set()),
+      (('enable', ()), set()),
+      (('disable', ()), set()),
+      (('start', ()), set()),
+      (('stop', ()), set()),
+    ))
+    for unit, (enable, start) in desired.items():
+      change_file = enable is not None \
+        and not self.is_static(unit) \
+        and enable != (unit in enabled)
+      change_state = start is not None \
+        and start != (unit in started)
+      if change_file and enable == start:
+        # enable --now does not restart running units and disable --now
+        # does not fail for stopped ones.
+        plan['enable' if enable else 'disable', ('--now',)].add(unit)
+        continue
+      if change_file:
+        plan['enable' if enable else 'disable', ()].add(unit)
+      if change_state:
+        plan['start' if start else 'stop', ()].add(unit)
+    return [
+      (command, list(args), units) for (command, args), units in plan.items() if units
+    ]
+
+  def is_enabled(self, unit):
+    return bool(self.units.get(unit) & UNIT_ENABLED)
+
+  def is_static(self, unit):
+    return bool(self.units.get(unit) & UNIT_STATIC)
 
   def is_started(self, unit):
-    return (unit in self.started)
+    return bool(self.units.get(unit) & UNIT_STARTED)
 
   def is_error(self, unit):
-    return (unit in self.error)
+    return bool(self.units.get(unit) & UNIT_ERROR)
 
   def get_sub(self, unit):
-    try:
-      return ' ' + self.sub[unit].rjust(self.sub_len, ' ') + ' '
-    except KeyError:
+    sub = self.units.sub(unit)
+    if sub is None:
       return ' ' * (self.sub_len + 2)
+    return ' ' + sub.rjust(self.sub_len, ' ') + ' '
 
+  def run_command(self, job):
+    return self.backend.run_command(job)
 
-  def run_command(self, command, services):
-    cmd = [
-      self.bin,
-    ] + self.args + [command,] + sorted(services)
-    command = ' '.join(shlex.quote(x) for x in cmd)
-    if DEBUG_LOG:
-      debug(command)
+
+
+class UnitFilter(object):
+  """
+  A filter for units parsed from an expression of whitespace-separated terms.
+
+  "is:<state>" and "type:<type>[,<type>...]" select units by the flags and
+  types kept by Systemd and may be negated with a leading "!". The other terms are joined to
+  a regular expression that is searched for in the names of the selected units.
+  The result is cached for each generation of the state.
+  """
+
+  def __init__(self, expression):
+    self.expression = expression
+    # (negated, flag) and (negated, types) tuples
+    self.states = list()
+    self.types = list()
+    words = list()
+    for term in expression.split():
+      negated = term.startswith('!')
+      key, sep, value = term[negated:].partition(':')
+      if sep and key == 'is':
+        try:
+          self.states.append((negated, FILTER_STATES[value]))
+        except KeyError:
+          raise ValueError('unknown state: {}'.format(value))
+      elif sep and key == 'type':
+        self.types.append((negated, value.split(',')))
+      else:
+        words.append(term)
+    try:
+      self.regex = re.compile(' '.join(words)) if words else None
+    except re.error as e:
+      raise ValueError('invalid regular expression: {}'.format(e))
+    self.cache = None
+
+  def units(self, systemd):
+    """
+    Return the set of units that match the filter. It must not be modified.
+    """
+    if self.cache is not None and self.cache[0] == systemd.generation:
+      return self.cache[1]
+    included = list()
+    excluded = list()
+    for negated, flag in self.states:
+      (excluded if negated else included).append(systemd.select(flag))
+    for negated, types in self.types:
+      (excluded if negated else included).append(systemd.select_types(types))
+    # Start with the smallest set so that "is:failed type:timer" only looks at
+    # the failed units.
+    if included:
+      included.sort(key=len)
+      units = included[0].intersection(*included[1:])
+    else:
+      units = set(systemd.services)
+    for other in excluded:
+      units -= other
+    if self.regex is not None:
+      units = set(filter(self.regex.search, units))
+    self.cache = (systemd.generation, units)
+    return units
+
+
+
+class Job(object):
+  """
+  A unit command for the JobRunner.
+
+  The state goes from "queued" to "running" and then to "done", "failed",
+  "timeout" or "cancelled". The output of the command is kept for the log and
+  error describes the reason for the last three states. results maps units to
+  an error message, or None if the command succeeded for them.
+  """
+
+  def __init__(self, command, units, timeout=None, args=()):
+    self.command = command
+    self.units = sorted(units)
+    self.timeout = timeout
+    # Options of the command, e.g. --now.
+    self.args = list(args)
+    self.cancelled = threading.Event()
+    self.state = 'queued'
+    self.error = None
+    self.output = None
+    self.started = None
+    self.results = dict()
+    self.chunks = 1
+    self.chunks_done = 0
+
+  def __str__(self):
+    units = self.units[:JOB_MAX_NAMES]
+    if len(self.units) > JOB_MAX_NAMES:
+      units.append('and {:d} more'.format(len(self.units) - JOB_MAX_NAMES))
+    return ' '.join([self.command] + self.args + units)
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def split(self, size):
+    """
+    Return jobs for chunks of at most size units. They share the cancellation
+    of this job and each has its timeout.
+    """
+    chunks = list()
+    for i in range(0, len(self.units), size):
+      chunk = Job(self.command, self.units[i:i+size], self.timeout, self.args)
+      chunk.cancelled = self.cancelled
+      chunks.append(chunk)
+    return chunks
+
+  def finish(self, props=None):
+    """
+    Set the final state from the results of the units. Units that failed are
+    checked against their new properties, if given, because a failed command
+    does not tell which of its units failed.
+    """
+    targets = list()
+    if self.command in UNIT_TARGET_STATES:
+      targets.append(UNIT_TARGET_STATES[self.command])
+    if '--now' in self.args:
+      targets.append(UNIT_TARGET_STATES['start' if self.command == 'enable' else 'stop'])
+    if targets and props is not None:
+      for unit, error in self.results.items():
+        unit_props = props.get(unit, {})
+        if error is not None \
+        and all(unit_props.get(key) in values for key, values in targets):
+          self.results[unit] = None
+    failed = sorted(unit for unit, error in self.results.items() if error is not None)
+    if self.state in ('running', 'failed'):
+      if not failed:
+        self.state = 'done'
+        self.error = None
+      elif len(self.units) == 1:
+        self.fail('failed', self.results[failed[0]])
+      else:
+        self.fail('failed', '{:d} of {:d} units failed'.format(len(failed), len(self.units)))
+    if failed and len(self.units) > 1:
+      self.output += '\nFailed units:'
+      for unit in failed:
+        self.output += '\n  {}: {}'.format(unit, self.results[unit])
+
+  def fail(self, state, error):
+    self.state = state
+    self.error = error
+
+  def check(self):
+    """
+    Return True if a running job should be stopped because it was cancelled or
+    timed out, and set its state accordingly.
+    """
+    if self.cancelled.is_set():
+      self.fail('cancelled', 'Cancelled.')
+    elif self.timeout is not None \
+    and time.monotonic() - self.started >= self.timeout:
+      self.fail('timeout', 'Timed out after {:g} s.'.format(self.timeout))
+    else:
+      return False
+    return True
+
+
+
+class Updater(threading.Thread):
+  """
+  Base class for threads that follow the state of systemd in the background.
+
+  Results are queued and applied to Systemd by the UI thread with apply(),
+  either as a full state computed with Systemd.query() or as properties of
+  individual units for Systemd.update_units(). Errors are queued as well and
+  the last one is left in error for the UI thread to show.
+  """
+
+  def __init__(self, systemd):
+    super().__init__(daemon=True)
+    self.systemd = systemd
+    self.results = queue.Queue()
+    self.stopped = threading.Event()
+    self.error = None
+
+  def stop(self):
+    self.stopped.set()
+
+  def put_state(self, generation=None):
+    """
+    Query the full state and queue it if it differs from the current one. If a
+    generation is given, the state is dropped if Systemd has changed since
+    then.
+    """
+    state = self.systemd.query()
+    if state is None:
       return
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    changed = self.systemd.diff(state)
+    if changed:
+      self.results.put(('state', generation, state, changed))
+
+  def put_units(self, props):
+    if self.results.qsize() >= MAX_PENDING_UPDATES:
+      self.resync()
+    else:
+      self.results.put(('units', props))
+
+  def resync(self):
+    """
+    Replace all pending results with a full state, e.g. after events were lost.
+    """
+    while True:
+      try:
+        self.results.get_nowait()
+      except queue.Empty:
+        break
+    self.put_state()
+
+  def retry_query(self, what):
+    """
+    Report that the query of the full state failed and repeat it every
+    QUERY_RETRY_DELAY seconds until it succeeds. Return the generation at which
+    the successful query started and the state, or None if the updater was
+    stopped first.
+    """
+    while True:
+      self.results.put((
+        'error',
+        'failed to {}, retrying in {:d} s'.format(what, QUERY_RETRY_DELAY)
+      ))
+      if self.stopped.wait(QUERY_RETRY_DELAY):
+        return None
+      since = self.systemd.generation
+      state = self.systemd.query()
+      if state is not None:
+        return since, state
+
+  def apply(self):
+    """
+    Apply the pending results and return the names of the changed units.
+    """
+    changed = set()
+    while True:
+      try:
+        result = self.results.get_nowait()
+      except queue.Empty:
+        break
+      if result[0] == 'units':
+        props = result[1]
+        self.systemd.update_units(props)
+        changed.update(props)
+      elif result[0] == 'error':
+        self.error = result[1]
+      elif result[0] == 'rebase':
+        # A full state that is applied even if the state changed while it was
+        # queried, keeping the units patched in the meantime.
+        since, state = result[1:]
+        self.systemd.keep_patched(state, since)
+        changed |= self.systemd.diff(state)
+        self.systemd.apply(state)
+      else:
+        generation, state, names = result[1:]
+        if generation is None or generation == self.systemd.generation:
+          if names is None:
+            names = self.systemd.diff(state)
+          self.systemd.apply(state)
+          changed |= names
+    return changed
+
+
+
+class BatchExecutor(object):
+  """
+  Run the command of a job in chunks of at most chunk_size units, up to
+  max_workers of them at a time, if the backend gains from it. Commands that
+  change unit files run in one piece as every call reloads the manager. The
+  results of the units are collected from the chunks.
+  """
+
+  def __init__(self, systemd, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+    self.systemd = systemd
+    self.chunk_size = chunk_size
+    self.max_workers = max_workers
+
+  def run(self, job):
+    """
+    Run the job and return its output.
+    """
+    if self.systemd.backend.concurrent \
+    and job.command not in UNIT_FILE_COMMANDS \
+    and len(job.units) > self.chunk_size:
+      chunks = job.split(self.chunk_size)
+    else:
+      chunks = [job]
+    job.chunks = len(chunks)
+    if len(chunks) == 1:
+      return self.run_chunk(job)
+    import concurrent.futures
+    outputs = dict()
+    with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(self.max_workers, len(chunks))
+    ) as executor:
+      futures = dict(
+        (executor.submit(self.run_chunk, chunk), i)
+        for i, chunk in enumerate(chunks)
+      )
+      for future in concurrent.futures.as_completed(futures):
+        outputs[futures[future]] = future.result()
+        job.chunks_done += 1
+    for chunk in chunks:
+      job.results.update(chunk.results)
+      if chunk.state in ('timeout', 'cancelled') and job.state == 'running':
+        job.fail(chunk.state, chunk.error)
+    return '\n'.join(outputs[i] for i in range(len(chunks)))
+
+  def run_chunk(self, chunk):
+    if chunk.cancelled.is_set():
+      chunk.fail('cancelled', 'Cancelled.')
+      output = '{}\n{}'.format(
+        ' '.join([chunk.command] + chunk.args + chunk.units),
+        chunk.error
+      )
+    else:
+      chunk.state = 'running'
+      chunk.started = time.monotonic()
+      output = self.systemd.run_command(chunk)
+    for unit in chunk.units:
+      if unit not in chunk.results:
+        chunk.results[unit] = chunk.error
+    return output
+
+
+
+class JobRunner(Updater):
+  """
+  Run the submitted jobs one after the other with a BatchExecutor and queue the
+  state of their units when they finish. Finished jobs are returned by
+  finished().
+  """
+
+  def __init__(self, systemd, executor=None):
+    super().__init__(systemd)
+    if executor is None:
+      executor = BatchExecutor(systemd)
+    self.executor = executor
+    self.pending = collections.deque()
+    self.condition = threading.Condition()
+    self.current = None
+    self.done = queue.Queue()
+
+  def submit(self, job):
+    with self.condition:
+      self.pending.append(job)
+      self.condition.notify()
+    return job
+
+  def cancel(self):
+    """
+    Cancel the running job and all queued ones.
+    """
+    with self.condition:
+      jobs = list(self.pending)
+      self.pending.clear()
+      if self.current is not None:
+        self.current.cancel()
+    for job in jobs:
+      job.cancel()
+      job.fail('cancelled', 'Cancelled.')
+      self.done.put(job)
+
+  def stop(self):
+    super().stop()
+    self.cancel()
+    with self.condition:
+      self.condition.notify()
+
+  def busy(self):
+    return self.current is not None or bool(self.pending)
+
+  def finished(self):
+    jobs = list()
+    while True:
+      try:
+        jobs.append(self.done.get_nowait())
+      except queue.Empty:
+        return jobs
+
+  def run(self):
+    while True:
+      with self.condition:
+        while not (self.pending or self.stopped.is_set()):
+          self.condition.wait()
+        if self.stopped.is_set():
+          return
+        job = self.current = self.pending.popleft()
+      job.state = 'running'
+      job.started = time.monotonic()
+      job.output = self.executor.run(job)
+      # Only the units of the job are re-read. Side effects on other units
+      # (e.g. started dependencies) are left to the other updaters.
+      props = self.systemd.show(job.units)
+      if props is None:
+        self.put_state()
+      else:
+        self.put_units(props)
+      job.finish(props)
+      with self.condition:
+        self.current = None
+      self.done.put(job)
+
+
+
+class Poller(Updater):
+  """
+  Query the full state periodically.
+  """
+
+  def __init__(self, systemd, interval):
+    super().__init__(systemd)
+    self.interval = interval
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.put_state(self.systemd.generation)
+
+
+
+class Revalidator(Updater):
+  """
+  Query the full state once to replace a stale one loaded from a snapshot.
+  """
+
+  def run(self):
+    since = self.systemd.generation
+    state = self.systemd.query()
+    if state is None:
+      # The snapshot stays on screen, marked as stale, in the meantime.
+      retried = self.retry_query('query systemd')
+      if retried is None:
+        return
+      since, state = retried
+    # Queued even without differences to clear the stale mark. Commands may be
+    # run on the stale units in the meantime.
+    self.results.put(('rebase', since, state))
+
+
+
+class Loader(Updater):
+  """
+  Query the initial state. The state of the loaded units is passed to the UI
+  thread by wait() as soon as it is known and the full state is queued when the
+  unit files have been listed.
+  """
+
+  def __init__(self, systemd):
+    super().__init__(systemd)
+    self.first = queue.Queue()
+    self.waited = False
+
+  def put_units_state(self, state):
+    if not self.waited:
+      self.waited = True
+      self.first.put((state, True))
+
+  def run(self):
+    since = self.systemd.generation
+    state = self.systemd.query(on_units=self.put_units_state)
+    if not self.waited:
+      self.waited = True
+      self.first.put((state, False))
+      return
+    if state is None:
+      # The loaded units are shown, so the unit files are listed again instead
+      # of giving up.
+      retried = self.retry_query('list the unit files')
+      if retried is None:
+        return
+      since, state = retried
+    # Commands may be run on the loaded units in the meantime.
+    self.results.put(('rebase', since, state))
+
+  def wait(self):
+    """
+    Wait for the first state and apply it. Return False if the query failed.
+    """
+    state, loading = self.first.get()
+    if state is None:
+      return False
+    self.systemd.apply(state, loading=loading)
+    return True
+
+
+
+class JournalWatcher(Updater):
+  """
+  Follow the messages that the manager logs to the journal when units change
+  state and re-read the state of the units that they name. Changes that are not
+  logged, such as unit files enabled by another process, are not noticed.
+  """
+
+  def __init__(self, systemd, args):
+    super().__init__(systemd)
+    if '--user' in args:
+      self.cmd = JOURNALCTL_CMD + ['--user', '_COMM=systemd']
+      self.field = 'USER_UNIT'
+    else:
+      self.cmd = JOURNALCTL_CMD + ['_PID=1']
+      self.field = 'UNIT'
+
+  def run(self):
     try:
-      output, err = p.communicate(cmd)
-      self.err = None
-      msg = command
-      if output:
-        msg += '\n' + output.decode()
-      if err:
-        msg += '\n' + err.decode()
-      return msg
-    except subprocess.TimeoutExpired as e:
+      p = subprocess.Popen(
+        self.cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+      )
+    except OSError:
+      return
+    fd = p.stdout.fileno()
+    buf = b''
+    pending = set()
+    try:
+      while not self.stopped.is_set():
+        # Wait briefly for more messages before re-reading the pending units so
+        # that bursts are handled with a single query.
+        if pending:
+          timeout = WATCH_BATCH_DELAY
+        else:
+          timeout = WATCH_TIMEOUT
+        r, w, x = select.select([fd], [], [], timeout)
+        if not r:
+          if pending:
+            props = self.systemd.show(pending)
+            if props is None:
+              self.resync()
+            else:
+              self.put_units(props)
+            pending = set()
+          continue
+        data = os.read(fd, 65536)
+        if not data:
+          # journalctl exited so further changes would be missed.
+          self.resync()
+          break
+        lines = (buf + data).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+          try:
+            unit = json.loads(line.decode())[self.field]
+          except (ValueError, KeyError, TypeError):
+            continue
+          if isinstance(unit, str):
+            pending.add(unit)
+    finally:
       p.kill()
-      self.err = str(e)
-      return self.err
-    except subprocess.CalledProcessError as e:
-      self.err = str(e)
-      return self.err
+      p.wait()
+      p.stdout.close()
+
+
+
+class DBusWatcher(Updater):
+  """
+  Apply the unit property changes that the manager signals over D-Bus.
+  """
+
+  def __init__(self, systemd, bus):
+    super().__init__(systemd)
+    self.bus = bus
+
+  def connect(self):
+    conn = jeepney.io.blocking.open_dbus_connection(bus=self.bus)
+    properties_rule = jeepney.MatchRule(
+      type='signal',
+      sender=SYSTEMD_BUS_NAME,
+      interface='org.freedesktop.DBus.Properties',
+      member='PropertiesChanged',
+      path_namespace=SYSTEMD_PATH + '/unit'
+    )
+    properties_rule.add_arg_condition(0, SYSTEMD_UNIT)
+    manager_rule = jeepney.MatchRule(
+      type='signal',
+      sender=SYSTEMD_BUS_NAME,
+      interface=SYSTEMD_MANAGER,
+      path=SYSTEMD_PATH
+    )
+    for rule in (properties_rule, manager_rule):
+      conn.send_and_get_reply(jeepney.message_bus.AddMatch(rule))
+    # The subscription lasts as long as the connection.
+    msg = jeepney.new_method_call(
+      jeepney.DBusAddress(
+        SYSTEMD_PATH,
+        bus_name=SYSTEMD_BUS_NAME,
+        interface=SYSTEMD_MANAGER
+      ),
+      'Subscribe'
+    )
+    jeepney.wrappers.unwrap_msg(conn.send_and_get_reply(msg))
+    return conn
+
+  def run(self):
+    while not self.stopped.is_set():
+      try:
+        conn = self.connect()
+      except (jeepney.DBusErrorResponse, OSError):
+        self.stopped.wait(WATCH_TIMEOUT)
+        continue
+      # Changes may have been missed before the subscription or while the
+      # connection was lost.
+      self.resync()
+      try:
+        while not self.stopped.is_set():
+          try:
+            msg = conn.receive(timeout=WATCH_TIMEOUT)
+          except TimeoutError:
+            continue
+          self.handle(msg)
+      except OSError:
+        pass
+      finally:
+        conn.close()
+
+  def handle(self, msg):
+    fields = msg.header.fields
+    member = fields.get(jeepney.HeaderFields.member)
+    if member == 'PropertiesChanged':
+      interface, changed, invalidated = msg.body
+      # Variants are (signature, value) tuples.
+      props = dict(
+        (key, value[1]) for key, value in changed.items()
+        if key in UNIT_PROPERTIES
+      )
+      if props:
+        unit = unit_name_from_path(fields[jeepney.HeaderFields.path])
+        self.put_units({unit : props})
+    elif member == 'UnitFilesChanged':
+      self.resync()
+    elif member == 'Reloading' and not msg.body[0]:
+      self.resync()
+
+#################################### Apply #####################################
+
+# State file keys and the (enable, start) selections that they set.
+STATE_FILE_KEYS = {
+  'enabled' : (0, True),
+  'disabled' : (0, False),
+  'started' : (1, True),
+  'stopped' : (1, False),
+}
+
+def load_state_file(path):
+  """
+  Load a state file and return a dict that maps units to (enable, start)
+  tuples for Systemd.plan(). Raise ValueError if the file is invalid.
+  """
+  if path == '-':
+    data = json.load(sys.stdin)
+  else:
+    with open(path) as f:
+      data = json.load(f)
+  if not isinstance(data, dict):
+    raise ValueError('expected an object')
+  desired = dict()
+  for key, units in data.items():
+    try:
+      i, value = STATE_FILE_KEYS[key]
+    except KeyError:
+      raise ValueError('unknown key: {}'.format(key))
+    if not isinstance(units, list) \
+    or not all(isinstance(unit, str) for unit in units):
+      raise ValueError('expected a list of unit names for {}'.format(key))
+    for unit in units:
+      selection = list(desired.get(unit, (None, None)))
+      if selection[i] is not None and selection[i] != value:
+        raise ValueError('conflicting states for {}'.format(unit))
+      selection[i] = value
+      desired[unit] = tuple(selection)
+  return desired
+
+def apply_state(systemd, desired, executor, timeout=None, dry_run=False):
+  """
+  Bring the units to their desired state and return a report. The commands of
+  the plan run one after the other, each with the executor.
+  """
+  units = dict()
+  planned = dict()
+  # Units whose state could not be read after their command.
+  unread = set()
+  for unit, (enable, start) in sorted(desired.items()):
+    if not systemd.is_known(unit):
+      units[unit] = {'result' : 'unknown', 'error' : 'no such unit'}
+      continue
+    units[unit] = {'result' : 'unchanged', 'error' : None}
+    if enable is False and systemd.is_static(unit):
+      # Static units cannot be disabled but may still be started or stopped,
+      # which the result is left to report.
+      units[unit]['skipped'] = 'disable: static unit'
+      enable = None
+    if enable is not None or start is not None:
+      planned[unit] = (enable, start)
+  plan = systemd.plan(planned)
+
+  commands = list()
+  for command, args, plan_units in plan:
+    job = Job(command, plan_units, timeout=timeout, args=args)
+    report = {
+      'command' : command,
+      'args' : job.args,
+      'units' : job.units,
+    }
+    commands.append(report)
+    for unit in job.units:
+      units[unit]['result'] = 'changed'
+    if dry_run:
+      continue
+    job.state = 'running'
+    job.started = time.monotonic()
+    job.output = executor.run(job)
+    props = systemd.show(job.units)
+    if props is None:
+      state = systemd.query()
+      if state is not None:
+        systemd.apply(state)
+    else:
+      state = None
+      systemd.update_units(props)
+    job.finish(props)
+    report['state'] = job.state
+    report['error'] = job.error
+    report['output'] = job.output
+    for unit in job.units:
+      error = job.results.get(unit)
+      if props is None and state is None:
+        # The new state is unknown, so it cannot be verified either.
+        unread.add(unit)
+        if error is None:
+          error = 'failed to load systemd data'
+      if error is not None:
+        units[unit]['result'] = 'failed'
+        units[unit]['error'] = error
+
+  if not dry_run:
+    for unit, unit_report in units.items():
+      if unit_report['result'] == 'unknown' or unit in unread:
+        continue
+      unit_report['enabled'] = systemd.is_enabled(unit) or systemd.is_static(unit)
+      unit_report['running'] = systemd.is_started(unit)
+      enable, start = planned.get(unit, (None, None))
+      if unit_report['result'] != 'failed' and (
+        (enable is not None and unit_report['enabled'] != enable)
+        or (start is not None and unit_report['running'] != start)
+      ):
+        unit_report['result'] = 'failed'
+        unit_report['error'] = 'the desired state was not reached'
+  return {
+    'ok' : not any(u['result'] in ('unknown', 'failed') for u in units.values()),
+    'dry_run' : dry_run,
+    'commands' : commands,
+    'units' : units,
+  }
+
+def apply_main(argv):
+  args = build_apply_argparser().parse_args(argv)
+
+  try:
+    desired = load_state_file(args.statefile)
+  except (OSError, ValueError) as e:
+    sys.stderr.write('error: failed to load {}: {}\n'.format(args.statefile, e))
+    sys.exit(1)
+  systemd = Systemd(get_backend(args))
+  try:
+    systemd.update()
+    report = apply_state(
+      systemd,
+      desired,
+      BatchExecutor(systemd, chunk_size=args.chunk_size, max_workers=args.max_workers),
+      timeout=args.timeout,
+      dry_run=args.dry_run
+    )
+  finally:
+    systemd.backend.close()
+  json.dump(report, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
+  sys.exit(0 if report['ok'] else 1)
 
 ##################################### Main #####################################
 
-def curses_main(stdscr, args):
+def import_jeepney():
+  """
+  Import jeepney into the global namespace. Return False if it is missing.
+  """
+  global jeepney
+  try:
+    import jeepney
+    import jeepney.io.blocking
+  except ImportError:
+    jeepney = None
+    return False
+  return True
+
+def import_curses():
+  """
+  Import curses into the global namespace for the interface.
+  """
+  global curses
+  import curses
+  import curses.textpad
+
+def get_backend(args):
+  backend = SystemctlBackend(args.bin, args.args, use_json=args.json)
+  if args.dbus:
+    if not import_jeepney():
+      sys.stderr.write('error: the D-Bus backend requires jeepney\n')
+      sys.exit(1)
+    bus = args.dbus
+    if bus == 'auto':
+      if '--user' in args.args:
+        bus = 'session'
+      else:
+        bus = 'system'
+    bus = {'system' : 'SYSTEM', 'session' : 'SESSION'}.get(bus, bus)
+    try:
+      backend = DBusBackend(bus, backend)
+    except (jeepney.DBusErrorResponse, OSError, KeyError) as e:
+      sys.stderr.write('error: failed to connect to systemd over D-Bus: {}\n'.format(e))
+      sys.exit(1)
+  return backend
+
+def curses_main(stdscr, systemd, args, profile=None, output=None):
   initialize()
-  systemd = Systemd(args.bin, args.args)
-  win = Window(stdscr, systemd)
+  win = Window(
+    stdscr,
+    systemd,
+    refresh=args.refresh,
+    watch=args.watch,
+    timeout=args.timeout,
+    chunk_size=args.chunk_size,
+    max_workers=args.max_workers,
+    profile=profile,
+    output=output
+  )
   win.draw()
+  if profile is not None:
+    profile.mark('curses')
   win.run()
 
 def main(args=None):
-  args = argparser.parse_args(args)
+  profile = StartupProfile()
+  profile.mark('import')
+  if args is None:
+    args = sys.argv[1:]
+  if args[:1] == ['apply']:
+    apply_main(args[1:])
+    return
+  args = build_argparser().parse_args(args)
+  if not args.startup_profile:
+    profile = None
+  if args.output_stats:
+    output = OutputStats()
+  else:
+    output = None
 
   global DEBUG_LOG
   DEBUG_LOG = args.debug
@@ -1079,7 +4052,39 @@ def main(args=None):
   PREFIX_OFF = args.off
   MIN_WIDTH = min(MIN_HDR_WIDTH, MIN_STATUS_WIDTH) + PREFIX_LEN + HELP_MSG_LEN + 1
 
-  curses.wrapper(curses_main, args)
+  if profile is not None:
+    profile.mark('arguments')
+  if args.cache:
+    scope = [args.bin] + args.args
+  else:
+    scope = None
+  systemd = Systemd(get_backend(args), scope=scope)
+  if profile is not None:
+    profile.mark('backend')
+
+  # Only the interface needs curses.
+  import_curses()
+
+  if output is not None:
+    try:
+      output.open()
+    except OSError as e:
+      sys.stderr.write('error: failed to relay the terminal output: {}\n'.format(e))
+      sys.exit(1)
+
+  try:
+    curses.wrapper(curses_main, systemd, args, profile, output)
+  finally:
+    if output is not None:
+      output.stop()
+      output.close()
+    systemd.save_snapshot()
+    systemd.backend.close()
+    # The interface is left with ctrl+c.
+    if profile is not None:
+      sys.stderr.write(profile.report())
+    if output is not None:
+      sys.stderr.write(output.report())
 
 if __name__ == '__main__':
   try: